@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Loan math that works on whole arrays at once.
+#
+# These follow the spreadsheet functions (PMT, IPMT,
+# PPMT, CUMIPMT, CUMPRINC), except that payments come
+# back as positive amounts. Any of the arguments can
+# be NumPy arrays (they broadcast), so a batch of runs
+# with their own rates gets costed in one call.
+#
+# The cumulative ones use the remaining balance in
+# closed form, instead of adding up every period:
+#
+#   balance(k) = pv * (1 + rate)^k
+#                - payment * (1 + rate * type) * ((1 + rate)^k - 1) / rate
+#
+# type is 0 for payments at the end of each period,
+# and 1 for payments at the start of it.
+####################################################
+
+import numpy as np
+
+
+def _result(values):
+    """Plain numbers back for plain numbers in """
+
+    return values[()] if values.ndim == 0 else values
+
+
+def _annuity(rate, periods):
+    """((1 + rate)^periods - 1) / rate, which is periods at a 0 rate """
+
+    rate = np.asarray(rate, dtype=np.float64)
+    periods = np.asarray(periods, dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(rate == 0, periods, np.expm1(periods * np.log1p(rate)) / rate)
+
+
+def _balance(rate, periods, pv, payment, type):
+    """What's owed at the end of periods (see above) """
+
+    rate = np.asarray(rate, dtype=np.float64)
+
+    return pv * (1 + rate) ** periods - payment * (1 + rate * type) * _annuity(rate, periods)
+
+
+def _principal_left(rate, periods, pv, payment, type):
+    """What's owed right after the periods'th payment """
+
+    balance = _balance(rate, periods, pv, payment, type)
+
+    # Paying up front, the balance at the end of a period already
+    # has that period's interest in it
+    return np.where((np.asarray(type) == 1) & (np.asarray(periods) > 0), balance / (1 + np.asarray(rate)), balance)
+
+
+def pmt(rate, nper, pv, fv=0, type=0):
+    """The payment that pays off pv (down to -fv) in nper periods """
+
+    rate = np.asarray(rate, dtype=np.float64)
+
+    payment = (pv * (1 + rate) ** nper + fv) / ((1 + rate * type) * _annuity(rate, nper))
+
+    return _result(np.asarray(payment))
+
+
+def ipmt(rate, per, nper, pv, fv=0, type=0):
+    """The interest part of the per'th payment (from 1 to nper) """
+
+    payment = pmt(rate, nper, pv, fv, type)
+    interest = np.asarray(rate) * _principal_left(rate, np.asarray(per) - 1, pv, payment, type)
+
+    # The first payment up front comes before any interest
+    return _result(np.where((np.asarray(type) == 1) & (np.asarray(per) == 1), 0.0, interest))
+
+
+def ppmt(rate, per, nper, pv, fv=0, type=0):
+    """The principal part of the per'th payment """
+
+    return _result(np.asarray(pmt(rate, nper, pv, fv, type) - ipmt(rate, per, nper, pv, fv, type)))
+
+
+def cumprinc(rate, nper, pv, start_period, end_period, fv=0, type=0):
+    """The principal paid from start_period to end_period (both included) """
+
+    payment = pmt(rate, nper, pv, fv, type)
+
+    paid = (_principal_left(rate, np.asarray(start_period) - 1, pv, payment, type) -
+            _principal_left(rate, end_period, pv, payment, type))
+
+    return _result(np.asarray(paid))
+
+
+def cumipmt(rate, nper, pv, start_period, end_period, fv=0, type=0):
+    """The interest paid from start_period to end_period (both included) """
+
+    payments = pmt(rate, nper, pv, fv, type) * (np.asarray(end_period) - start_period + 1)
+
+    return _result(np.asarray(payments - cumprinc(rate, nper, pv, start_period, end_period, fv, type)))
+
+
+def amortize(principal, annual_rates, periods_per_year=12):
+    """Pays principal off over as many years as there are annual_rates
+    (the last axis), at each year's rate. Every year, what's left is
+    amortized over the years that are left at that year's rate (like
+    an adjustable rate resetting, or a refinance that keeps the term).
+
+    Returns a dict of arrays shaped like annual_rates: the "payment",
+    "interest" and "principal" paid in each year, and the "balance"
+    left at the end of it """
+
+    rates = np.asarray(annual_rates, dtype=np.float64) / periods_per_year
+    years = rates.shape[-1]
+
+    balance = np.array(np.broadcast_to(np.asarray(principal, dtype=np.float64), rates.shape[:-1]))
+    schedule = {name: np.empty(rates.shape) for name in ("payment", "interest", "principal", "balance")}
+
+    for year in range(years):
+        rate = rates[..., year]
+        periods = (years - year) * periods_per_year
+
+        yearly_payment = pmt(rate, periods, balance) * periods_per_year
+        paid = cumprinc(rate, periods, balance, 1, periods_per_year)
+
+        balance = balance - paid
+
+        schedule["payment"][..., year] = yearly_payment
+        schedule["principal"][..., year] = paid
+        schedule["interest"][..., year] = yearly_payment - paid
+        schedule["balance"][..., year] = balance
+
+    return schedule
+
+
+def mortgage_payments(scenario, max_years):
+    """The mortgage payments in each relative year of the scenario. They're
+    fixed dollar amounts (they don't go up with inflation) """
+
+    payments = np.zeros(max_years)
+
+    if not scenario["mortgage_principal"]:
+        return payments
+
+    term = scenario["mortgage_years"]
+    start_age = scenario["mortgage_start_age"]
+
+    # The rate from each age on (ages can be strings, from JSON)
+    rates = np.full(term, float(scenario["mortgage_rate"]))
+
+    for age, rate in sorted((int(age), rate) for age, rate in scenario["mortgage_rate_changes"].items()):
+        rates[max(age - start_age, 0):] = rate
+
+    schedule = amortize(scenario["mortgage_principal"], rates)["payment"]
+
+    # The loan can start before (or after) the first relative year
+    first_payment = start_age - scenario["start_age"]
+    first_year = max(first_payment, 0)
+    skipped = first_year - first_payment
+    count = min(term - skipped, max_years - first_year)
+
+    if count > 0:
+        payments[first_year:first_year + count] = schedule[skipped:skipped + count]
+
+    return payments
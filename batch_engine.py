@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Vectorized version of the run_experiment() loop.
+#
+# Instead of walking every iteration and every
+# relative year in Python, a whole block of runs is
+# simulated as (runs x max_years) arrays. The per-year
+# math is done in the same order as the scalar loop so
+# both produce the same failure years for the same
+# rate paths.
+####################################################
+
+from collections import Counter
+
+import numpy as np
+
+import amortization
+
+# Bump this when a change to the engine changes its results
+# (it's part of the result cache's fingerprint)
+VERSION = 1
+
+
+def simulate(scenario, max_years, paths):
+    """Runs every row of the rate paths (see RateSampler.sample())
+    through the scenario. Returns a (runs, max_years) matrix of the
+    investment money at the end of each relative year """
+
+    return _simulate(scenario, max_years, paths, None)
+
+
+def trajectories(scenario, max_years, paths):
+    """Like simulate(), but returns a dict of (runs, max_years) matrices
+    with the yearly numbers of every run: investment_money, yearly_income,
+    yearly_expenses, inflation_rate and investment_return. The years
+    after a run ran out of money are NaN (the scalar loop stops there) """
+
+    detail = dict()
+    balances = _simulate(scenario, max_years, paths, detail)
+
+    detail["investment_money"] = balances
+    detail["inflation_rate"] = paths["inflation_rates"][:, :max_years].copy()
+
+    fail_years = failure_years(balances)
+    after_failure = np.arange(max_years) > fail_years[:, np.newaxis]
+
+    for matrix in detail.values():
+        matrix[after_failure] = np.nan
+
+    return detail
+
+
+def survivors(scenario, max_years, paths):
+    """Which runs never ran out of money in max_years relative years (a
+    boolean per run). Runs are dropped from the loop once they've run
+    out, since nothing after that changes their outcome """
+
+    return _simulate(scenario, max_years, paths, None, survivors_only=True)
+
+
+def retirement_state(scenario, max_years, paths):
+    """Where every run stands going into its retirement year (see
+    checkpoint.py), for resume_failure_years(): a dict of arrays """
+
+    first_year = min(scenario["retire_age"] - scenario["start_age"], max_years)
+    runs = paths["cascaded_inflation_rates"].shape[0]
+
+    if first_year:
+        balances = _simulate(scenario, first_year, paths, None)
+        out_of_money = balances <= 0
+
+        investment_money = balances[:, -1]
+        failed_in = np.where(out_of_money.any(axis=1), out_of_money.argmax(axis=1), -1)
+    else:
+        investment_money = np.full(runs, float(scenario["investment_money"]))
+        failed_in = np.full(runs, -1)
+
+    return {
+        "first_year": np.array([first_year]),
+        "investment_money": investment_money,
+        "retirement_401k": _retirement_401k(scenario, paths, first_year),
+        "failed_in": failed_in.astype(np.int16),
+    }
+
+
+def resume_failure_years(scenario, max_years, state, paths):
+    """failure_years() for the scenario, picking the runs up from a
+    retirement_state(). paths are the same rate paths the state came
+    from (only the years from retirement on are used). The scenario can
+    only differ from the one the state came from in what happens after
+    retiring """
+
+    first_year = int(state["first_year"][0])
+
+    if first_year != min(scenario["retire_age"] - scenario["start_age"], max_years):
+        raise ValueError("The checkpoint is for a different retirement year")
+
+    balances = _simulate(scenario, max_years, paths, None,
+                         start=(first_year, state["investment_money"], state["retirement_401k"]))
+
+    return np.where(state["failed_in"] >= 0, state["failed_in"], failure_years(balances))
+
+
+def _retirement_401k(scenario, paths, years):
+    """The 401k after growing for years, when it's cashed out """
+
+    retirement_401k = np.full(paths["conservative_returns"].shape[0], float(scenario["retirement_401k_base"]))
+
+    for rel_year in range(years):
+        retirement_401k = (retirement_401k + scenario["retirement_401k_contribution"]) * (1 + paths["conservative_returns"][:, rel_year])
+
+    return retirement_401k
+
+
+def _simulate(scenario, max_years, paths, detail, survivors_only=False, start=None):
+    """start is (first relative year, investment money going into it,
+    the 401k), to pick the runs up part way (see retirement_state()) """
+
+    cascaded_inflation = paths["cascaded_inflation_rates"][:, :max_years]
+    runs = cascaded_inflation.shape[0]
+
+    start_year = scenario["birth_year"] + scenario["start_age"]
+    end_year = scenario["birth_year"] + scenario["retire_age"]
+
+    years = start_year + np.arange(max_years)
+    retired = years >= end_year
+
+    # Relative year of retirement (when the 401k is cashed out
+    # and the portfolio switches to conservative returns)
+    retire_rel_year = end_year - start_year
+
+    ########################################################
+    # Salary/expense phases - these are the same for every run
+    pretax_salary = np.where(retired, 0, scenario["pretax_salary"])
+    yearly_salaries = pretax_salary - (pretax_salary * scenario["income_tax_rate"])
+
+    monthly_expenses = np.where(retired,
+                                scenario["retire_monthly_living_expenses"] + scenario["retire_monthly_petty_expenses"],
+                                scenario["monthly_living_expenses"] + scenario["monthly_petty_expenses"])
+
+    ss_years = ((scenario["birth_year"] + scenario["ss_start_age"] <= years) &
+                (years <= scenario["birth_year"] + scenario["ss_end_age"]))
+    ss_income = np.where(ss_years, scenario["retire_ss_payment"] * 12, 0)
+
+    ########################################################
+    # Per-run expenses (adjusted for inflation), and the mortgage
+    withdraw_amt_afi = monthly_expenses * 12 * cascaded_inflation
+
+    mortgage = amortization.mortgage_payments(scenario, max_years)
+
+    if mortgage.any():
+        withdraw_amt_afi = withdraw_amt_afi + mortgage
+    yearly_expenses = withdraw_amt_afi + withdraw_amt_afi * scenario["investment_withdraw_tax_rate"]
+
+    # Returns switch to the conservative ones the year after retiring
+    rates = np.where(np.arange(max_years) > retire_rel_year,
+                     paths["conservative_returns"][:, :max_years],
+                     paths["historical_returns"][:, :max_years])
+
+    ########################################################
+    # 401k grows until it is cashed out at retirement
+    if start is None:
+        first_year = 0
+        retirement_401k = _retirement_401k(scenario, paths, min(retire_rel_year, max_years))
+        investment_money = np.full(runs, float(scenario["investment_money"]))
+    else:
+        first_year, investment_money, retirement_401k = start
+
+    ########################################################
+    if survivors_only:
+        balances = None
+    else:
+        balances = np.full((runs, max_years), np.nan) if first_year else np.empty((runs, max_years))
+
+    if detail is not None:
+        detail["yearly_income"] = np.empty((runs, max_years))
+        detail["yearly_expenses"] = yearly_expenses.copy()
+        detail["investment_return"] = rates.copy()
+
+    # For survivors_only: the runs still in the loop, and which of them are out of money
+    remaining = np.arange(runs)
+    out_of_money = np.zeros(runs, dtype=bool)
+
+    for rel_year in range(first_year, max_years):
+        yearly_income = investment_money * rates[:, rel_year] + yearly_salaries[rel_year]
+
+        if ss_income[rel_year]:
+            yearly_income = yearly_income + ss_income[rel_year]
+
+        if detail is not None:
+            detail["yearly_income"][:, rel_year] = yearly_income
+
+        investment_money = investment_money + (yearly_income - yearly_expenses[:, rel_year])
+
+        if rel_year == retire_rel_year:
+            investment_money = investment_money + retirement_401k
+
+        if not survivors_only:
+            balances[:, rel_year] = investment_money
+            continue
+
+        out_of_money |= investment_money <= 0
+
+        # Copying the rows costs more than it saves until enough are out
+        if out_of_money.sum() * 4 > len(out_of_money):
+            keep = ~out_of_money
+
+            remaining = remaining[keep]
+            investment_money = investment_money[keep]
+            retirement_401k = retirement_401k[keep]
+            rates = rates[keep]
+            yearly_expenses = yearly_expenses[keep]
+            out_of_money = out_of_money[keep]
+
+    if survivors_only:
+        survived = np.zeros(runs, dtype=bool)
+        survived[remaining[~out_of_money]] = True
+
+        return survived
+
+    return balances
+
+
+def failure_years(balances):
+    """The relative year each run ran out of money. Runs that never
+    did are reported in the last year (like the scalar loop does) """
+
+    out_of_money = balances <= 0
+    max_years = balances.shape[1]
+
+    return np.where(out_of_money.any(axis=1), out_of_money.argmax(axis=1), max_years - 1)
+
+
+def failure_histogram(fail_years):
+    """Same shape as the rel_years dict built by run_experiment() """
+
+    years, counts = np.unique(fail_years, return_counts=True)
+
+    return Counter(dict(zip(years.tolist(), counts.tolist())))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+####################################################
+# Benchmarks for the simulator.
+#
+#   benchmark.py run      - times the hot pieces on
+#                           their own, and whole runs of
+#                           monte_carlo.py across worker
+#                           counts, MAX_YEARS and RUNS.
+#                           The results are appended to
+#                           the history file.
+#   benchmark.py compare  - compares the last result in
+#                           the history to an earlier one,
+#                           and flags regressions.
+#
+# Every result is in operations per second (higher is
+# better).
+####################################################
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import timeit
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Settings that make monte_carlo.py do something other than a plain
+# run (or skip the work), which aren't passed on from the shell
+MODE_ENV = ("CACHE_DIR", "CONVERGE", "SWEEP_FILE", "SOLVE_FOR", "COORDINATOR", "OUTCOME_SINK", "CHECKPOINT_DIR",
+            "TRACE_SAMPLE", "TRACE_WORST", "TRACE_FILE", "PROFILE", "METRICS_FILE", "TIME_BUDGET")
+
+# In the current directory, not next to the code
+DEFAULT_HISTORY = "benchmark_history.jsonl"
+
+
+def _per_second(func, repeat=5):
+    """Calls per second of func, from the best of repeat timings """
+
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+
+    return number / min(timer.repeat(repeat=repeat, number=number))
+
+
+def micro_benchmarks(max_years):
+    """Times the hot pieces of a single run """
+
+    import FinanceFuture as future
+    import amortization
+    import batch_engine as batch
+    import monte_carlo
+    import rate_sampler
+    import seeding
+
+    monte_carlo.SIMULATE = True
+
+    seed = seeding.chunk_seed(0, 0)
+    ff = future.FinanceFuture(max_years=max_years, rng=seeding.market_data_rng(seed))
+    ff.set_rng(seeding.chunk_rng(seed))
+
+    ff.investment_money = 100000
+    ff.pretax_salary = 55555
+    ff.monthly_living_expenses = 888
+    ff.monthly_petty_expenses = 222
+
+    run_date = datetime(year=2020, month=12, day=31)
+    paths = ff.sampler.sample(1000)
+
+    # The padded series are all max_years + 1 long, so they work for the joint modes too
+    joint_samplers = {mode: rate_sampler.RateSampler(ff.sampler.base_rates, ff.rng, mode=mode, path_length=max_years + 1)
+                      for mode in rate_sampler.MODES[1:]}
+
+    # A 30 year loan per run, with its own rate every year
+    loan_rates = ff.rng.uniform(.03, .08, (1000, 30))
+
+    results = {
+        "shuffle_rates_and_returns": _per_second(ff.shuffle_rates_and_returns),
+        "cascade": _per_second(lambda: ff.cascade(ff.inflation_rates, len(ff.inflation_rates))),
+        "yearly_income": _per_second(lambda: ff.yearly_income(run_date, 10)),
+        "yearly_expenses": _per_second(lambda: ff.yearly_expenses(run_date, 10)),
+        "run_experiment_iteration": _per_second(lambda: monte_carlo.run_experiment(1, max_years, seed), repeat=3),
+        "batch_sample_1000_runs": _per_second(lambda: ff.sampler.sample(1000), repeat=3),
+        "batch_simulate_1000_runs": _per_second(lambda: batch.simulate(monte_carlo.SCENARIO, max_years, paths), repeat=3),
+        "cumipmt_360_periods": _per_second(lambda: ff.cumipmt(.05 / 12, 360, 300000, 1, 360)),
+        "amortize_1000_variable_rate_loans": _per_second(lambda: amortization.amortize(300000, loan_rates), repeat=3),
+    }
+
+    for mode, sampler in joint_samplers.items():
+        results["batch_sample_1000_runs_" + mode] = _per_second(partial(sampler.sample, 1000), repeat=3)
+
+    return results
+
+
+def end_to_end(workers, max_years, runs, extra_env=None):
+    """Runs monte_carlo.py as a separate process (like the container
+    does). Returns the Iters/Sec it reports, and iterations per second
+    of wall-clock time (including startup) """
+
+    env = {name: value for name, value in os.environ.items() if name not in MODE_ENV}
+    env.update(WORKERS=str(workers), MAX_YEARS=str(max_years), RUNS=str(runs), MASTER_SEED="1")
+    env.update(extra_env or {})
+
+    start_time = time.time()
+    output = subprocess.run([sys.executable, os.path.join(HERE, "monte_carlo.py")], env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    elapsed_time = time.time() - start_time
+
+    match = re.search(r"# Iters/Sec: ([\d.]+)", output)
+
+    if match is None:
+        raise RuntimeError("monte_carlo.py didn't print \"# Iters/Sec\" (is a setting in the environment "
+                           "changing what it does?). Its output was:\n{0}".format(output))
+
+    return float(match.group(1)), runs / elapsed_time
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = dict()
+
+    for max_years in args.max_years:
+        for name, value in micro_benchmarks(max_years).items():
+            results["micro/{0}/years={1}".format(name, max_years)] = value
+
+    for workers in args.workers:
+        for max_years in args.max_years:
+            for runs in args.runs:
+                reported, wall_clock = end_to_end(workers, max_years, runs)
+                key = "e2e/workers={0}/years={1}/runs={2}".format(workers, max_years, runs)
+
+                results[key] = reported
+                results[key + "/wall_clock"] = wall_clock
+
+    record = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": mp.cpu_count(),
+        "results": results,
+    }
+
+    with open(args.history, "a") as fh:
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+
+    width = max(len(name) for name in results)
+
+    for name, value in sorted(results.items()):
+        print("{0:<{1}}  {2:>14,.1f}/s".format(name, width, value))
+
+
+def _load_history(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def compare(args):
+    history = _load_history(args.history)
+
+    if len(history) < 2:
+        print("Need at least two results in {0} to compare".format(args.history))
+        return 1
+
+    current = history[-1]
+
+    if args.baseline is None:
+        baseline = history[-2]
+    else:
+        matches = [record for record in history[:-1] if args.baseline in (record.get("label"), record.get("commit"))]
+
+        if not matches:
+            print("No result labeled (or from commit) {0} in {1}".format(args.baseline, args.history))
+            return 1
+
+        baseline = matches[-1]
+
+    print("Baseline: {0} ({1})  Current: {2} ({3})\n".format(baseline.get("label") or baseline.get("commit"), baseline["time"],
+                                                            current.get("label") or current.get("commit"), current["time"]))
+
+    regressions = 0
+    names = sorted(set(baseline["results"]) & set(current["results"]))
+    width = max([len(name) for name in names] + [1])
+
+    for name in names:
+        change = current["results"][name] / baseline["results"][name] - 1
+        flag = ""
+
+        if change < -args.threshold:
+            flag = "REGRESSION"
+            regressions += 1
+
+        print("{0:<{1}}  {2:>14,.1f}/s  {3:>14,.1f}/s  {4:>+8.1%}  {5}".format(
+            name, width, baseline["results"][name], current["results"][name], change, flag))
+
+    print("\n{0} regression(s) worse than {1:.0%}".format(regressions, args.threshold))
+
+    return 1 if regressions else 0
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the monte carlo simulator")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON lines file of results (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks, and add the results to the history")
+    run_parser.add_argument("--label", help="Name for this result (e.g. a version)")
+    run_parser.add_argument("--workers", type=_int_list,
+                            default=[count for count in (1, 2, 4, 8, 16, 32, 64) if count <= mp.cpu_count()],
+                            help="Comma separated worker counts (default: powers of 2 up to the CPU count)")
+    run_parser.add_argument("--max-years", type=_int_list, default=[100], help="Comma separated MAX_YEARS (default: 100)")
+    run_parser.add_argument("--runs", type=_int_list, default=[10000, 100000], help="Comma separated RUNS (default: 10000,100000)")
+
+    compare_parser = commands.add_parser("compare", help="Compare the last result to an earlier one")
+    compare_parser.add_argument("--baseline", help="Label or commit to compare to (default: the result before the last)")
+    compare_parser.add_argument("--threshold", type=float, default=.10,
+                                help="Slowdown that counts as a regression (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+        return 0
+
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
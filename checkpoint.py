@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Checkpoints of every run going into retirement.
+#
+# Most what-ifs only change the retirement years (the
+# retirement expenses, social security), but the
+# working years get simulated all over again every
+# time. With CHECKPOINT_DIR set, every chunk saves
+# where its runs stand going into the retirement year:
+# the investment money, the 401k about to be cashed
+# out, and the year they ran out of money (if they
+# already did). That's 18 bytes a run.
+#
+# Later jobs whose working years are the same (same
+# seed, rates and pre-retirement inputs) load that and
+# only simulate the retirement years. The rates for
+# those get sampled again from the chunk's seed, which
+# gives the same paths as the first time. Chunks are saved
+# as soon as they're done, so an interrupted job picks
+# up where it left off, too.
+#
+# Each fingerprint gets its own directory, with one
+# .npz file per chunk. When they add up to more than
+# the size limit, the least recently used fingerprints
+# are removed.
+####################################################
+
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Scenario keys that only matter once retired
+RETIREMENT_KEYS = ("retire_monthly_living_expenses", "retire_monthly_petty_expenses")
+
+# These only matter once retired if social security starts then (or later)
+SOCIAL_SECURITY_KEYS = ("retire_ss_payment", "ss_start_age", "ss_end_age")
+
+FIELDS = ("first_year", "investment_money", "retirement_401k", "failed_in")
+
+
+def accumulation_scenario(scenario):
+    """The part of scenario the working years depend on """
+
+    working = {key: value for key, value in scenario.items() if key not in RETIREMENT_KEYS}
+
+    if scenario["ss_start_age"] >= scenario["retire_age"]:
+        for key in SOCIAL_SECURITY_KEYS:
+            del working[key]
+
+        working["ss_starts_after_working"] = True
+
+    return working
+
+
+def concatenate(states):
+    """Joins the states of consecutive batches of runs """
+
+    state = {field: np.concatenate([batch_state[field] for batch_state in states]) for field in FIELDS if field != "first_year"}
+    state["first_year"] = states[0]["first_year"]
+
+    return state
+
+
+def rows(state, start, stop):
+    """The state of the runs from start to stop """
+
+    part = {field: state[field][start:stop] for field in FIELDS if field != "first_year"}
+    part["first_year"] = state["first_year"]
+
+    return part
+
+
+class CheckpointStore(object):
+    def __init__(self, path, key, max_bytes=2048 * 2 ** 20):
+        self.path = path
+        self.key = key
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def spec(self):
+        """What a worker needs to open_store() """
+
+        return (self.path, self.key)
+
+    @property
+    def directory(self):
+        return os.path.join(self.path, self.key)
+
+    def _file(self, index, size):
+        return os.path.join(self.directory, "chunk_{0:08d}_{1}.npz".format(index, size))
+
+    def load(self, index, size):
+        """The state of the runs in a chunk, or None if it isn't saved """
+
+        try:
+            with np.load(self._file(index, size)) as data:
+                return {field: data[field] for field in FIELDS}
+        except FileNotFoundError:
+            return None
+
+    def save(self, index, size, state):
+        # Write it somewhere else first so readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as fh:
+            np.savez(fh, **state)
+
+        os.replace(tmp_path, self._file(index, size))
+
+    def saved_chunks(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith(".npz"))
+
+    def evict(self):
+        """Removes the least recently used fingerprints (other than this one)
+        until the checkpoints fit in max_bytes """
+
+        # Mark this one as recently used
+        os.utime(self.directory)
+
+        entries = list()
+
+        for name in os.listdir(self.path):
+            directory = os.path.join(self.path, name)
+
+            if os.path.isdir(directory):
+                size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+                entries.append((os.stat(directory).st_mtime, size, name))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            if name != self.key:
+                logger.debug("Evicting {0} from the checkpoints".format(name))
+                shutil.rmtree(os.path.join(self.path, name))
+                total -= size
+
+
+def open_store(spec):
+    path, key = spec
+
+    return CheckpointStore(path, key)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Early stopping for the simulation.
+#
+# The runs are done in rounds. After each round the
+# success percentage for every relative year gets a
+# confidence interval, and the job stops once the
+# year where success drops below LOWER_PCT is pinned
+# down to within TOLERANCE years (or the run/time
+# budget is used up).
+####################################################
+
+import logging
+import time
+from collections import Counter
+from statistics import NormalDist
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def survival_counts(cnt, max_years):
+    """How many runs still had money at each relative year (the
+    runs that failed in that year or later) """
+
+    failures = np.zeros(max_years, dtype=np.int64)
+
+    for year, count in cnt.items():
+        failures[year] += count
+
+    return failures[::-1].cumsum()[::-1]
+
+
+def wilson_interval(successes, runs, z):
+    """Wilson score interval for a success proportion """
+
+    pct = successes / runs
+    denominator = 1 + z ** 2 / runs
+    center = (pct + z ** 2 / (2 * runs)) / denominator
+    spread = z * np.sqrt(pct * (1 - pct) / runs + z ** 2 / (4 * runs ** 2)) / denominator
+
+    return center - spread, center + spread
+
+
+def chi2_quantile(q, dof):
+    """The q quantile of a chi-square with dof degrees of freedom
+    (Wilson-Hilferty, which is close enough from a few dof up) """
+
+    z = NormalDist().inv_cdf(q)
+
+    return dof * max(1 - 2 / (9 * dof) + z * np.sqrt(2 / (9 * dof)), 0) ** 3
+
+
+def cutoff_year(pcts, success_rate):
+    """The last relative year with a success percentage of at least
+    success_rate (-1 if there's none). The percentages only go down
+    as the years go by, so it's just a count """
+
+    return np.count_nonzero(pcts >= success_rate) - 1
+
+
+class ConvergenceMonitor(object):
+    def __init__(self, max_years, success_rate, tolerance=1, confidence=.95):
+        self.max_years = max_years
+        self.success_rate = success_rate
+        self.tolerance = tolerance
+        self.confidence = confidence
+
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def cutoff_range(self, cnt):
+        """The earliest and latest the cutoff year could be, given
+        the confidence interval of every year's success percentage """
+
+        runs = sum(cnt.values())
+        lower, upper = wilson_interval(survival_counts(cnt, self.max_years), runs, self.z)
+
+        return cutoff_year(lower, self.success_rate), cutoff_year(upper, self.success_rate)
+
+
+def run_until_converged(scheduler, experiment, max_years, entropy, monitor, max_runs, round_size, time_budget=None):
+    """Runs rounds of round_size runs until the monitor says the cutoff
+    year is stable, max_runs is reached, or time_budget (seconds) is up.
+
+    round_size gets rounded up to whole chunks, so the chunks (and seeds)
+    are the same as a regular job with the same number of runs.
+
+    Returns the merged failure counts and why it stopped """
+
+    chunk_size = scheduler.chunk_size
+    round_size = max(1, -(-round_size // chunk_size)) * chunk_size
+
+    start_time = time.time()
+    cnt = Counter()
+    runs_done = 0
+
+    while True:
+        runs = min(round_size, max_runs - runs_done)
+        cnt.update(scheduler.run(experiment, runs, max_years, entropy, start_chunk=runs_done // chunk_size))
+        runs_done += runs
+
+        earliest, latest = monitor.cutoff_range(cnt)
+        logger.info("{0} runs: cutoff year between {1} and {2}".format(runs_done, earliest, latest))
+
+        if latest - earliest <= monitor.tolerance:
+            return cnt, "converged"
+
+        if runs_done >= max_runs:
+            return cnt, "max runs reached"
+
+        if time_budget is not None and time.time() - start_time >= time_budget:
+            return cnt, "time budget reached"
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+####################################################
+# Runs the chunks on worker daemons on other hosts.
+#
+# With COORDINATOR=host:port, monte_carlo.py doesn't
+# start a local pool. It listens there instead, and
+# worker daemons connect to it (over TCP, through
+# multiprocessing.managers, with COORDINATOR_AUTHKEY
+# as the shared secret):
+#
+#   distributed.py worker --coordinator host:port
+#
+# Workers pull a chunk at a time (its size, and the
+# seed to run it with) and push back what the
+# experiment returned, which gets merged as if a
+# local worker had run it. Every chunk has its own
+# seed, so the results are the same no matter which
+# worker ran what.
+#
+# Workers send a heartbeat every few seconds. When a
+# worker misses them for WORKER_TIMEOUT seconds, its
+# chunks go back in the queue for another worker. If
+# it turns up with the results after all, they're
+# dropped (they'd be the same anyway).
+#
+# The daemons keep running between jobs, waiting for
+# the next coordinator. They need the same code as the
+# coordinator (it checks), and the job's settings (the
+# scenario, SAMPLING and such) come from the
+# coordinator. Anything the experiments read or write
+# by path (MARKET_DATA_FILE, CHECKPOINT_DIR) has to be
+# at the same path on every host.
+#
+# The chunks are pickled both ways, so only run this
+# on a network where everyone with the authkey is
+# trusted.
+####################################################
+
+import argparse
+import collections
+import glob
+import hashlib
+import importlib
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from functools import partial
+from multiprocessing.managers import BaseManager
+
+import market_data
+import metrics
+import seeding
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The methods workers can call on the coordinator
+EXPOSED = ("get_settings", "job_state", "get_task", "heartbeat", "put_result", "put_error")
+
+
+class WorkerError(Exception):
+    pass
+
+
+class _WorkerManager(BaseManager):
+    pass
+
+
+_WorkerManager.register("coordinator")
+
+
+def parse_address(address):
+    """(host, port) from "host:port" """
+
+    host, _, port = address.rpartition(":")
+
+    if not host or not port.isdigit():
+        raise ValueError("Expected host:port, got {0}".format(address))
+
+    return host, int(port)
+
+
+def authkey():
+    """The shared secret from COORDINATOR_AUTHKEY """
+
+    key = os.environ.get("COORDINATOR_AUTHKEY")
+
+    if not key:
+        raise ValueError("COORDINATOR_AUTHKEY has to be set (the same on the coordinator and every worker)")
+
+    return key.encode()
+
+
+def code_version():
+    """A hash of the code, to keep out workers running something else """
+
+    digest = hashlib.sha256()
+
+    for path in sorted(glob.glob(os.path.join(HERE, "*.py"))):
+        digest.update(os.path.basename(path).encode())
+
+        with open(path, "rb") as fh:
+            digest.update(fh.read())
+
+    return digest.hexdigest()
+
+
+def _module_name(module):
+    """The importable name of module (the script's, for __main__) """
+
+    if module == "__main__":
+        return os.path.splitext(os.path.basename(sys.modules["__main__"].__file__))[0]
+
+    return module
+
+
+def _reference(experiment):
+    """What a worker needs to find experiment: (module, name, keyword args) """
+
+    keywords = dict()
+
+    if isinstance(experiment, partial):
+        keywords = experiment.keywords
+        experiment = experiment.func
+
+    return (_module_name(experiment.__module__), experiment.__qualname__, keywords)
+
+
+def _resolve(reference):
+    module, name, keywords = reference
+    experiment = getattr(importlib.import_module(module), name)
+
+    return partial(experiment, **keywords) if keywords else experiment
+
+
+class Coordinator(object):
+    def __init__(self, settings, worker_timeout=30):
+        """The coordinator's bookkeeping. Workers call it through the
+        manager (from its threads), so everything is under the lock """
+
+        self.settings = settings
+        self.worker_timeout = worker_timeout
+
+        self.lock = threading.Lock()
+        self.results = queue.Queue()
+
+        # Task id -> task, for the ones that haven't come back
+        self.tasks = dict()
+        self.pending = collections.deque()
+        # Task id -> the worker that has it
+        self.assigned = dict()
+
+        # Worker id -> when it was last heard from
+        self.last_seen = dict()
+        self.slots = dict()
+
+        self.next_id = 0
+        self.closed = False
+
+    def submit(self, tasks):
+        """Queues the tasks, and returns their ids """
+
+        with self.lock:
+            task_ids = list(range(self.next_id, self.next_id + len(tasks)))
+            self.next_id += len(tasks)
+
+            self.tasks.update(zip(task_ids, tasks))
+            self.pending.extend(task_ids)
+
+        return task_ids
+
+    def _seen(self, worker_id):
+        if worker_id not in self.last_seen:
+            logger.info("Worker {0} connected".format(worker_id))
+            self.slots[worker_id] = len(self.slots)
+
+        self.last_seen[worker_id] = time.time()
+
+    def check_workers(self):
+        """Puts the tasks of workers that haven't been heard from
+        back in the queue """
+
+        with self.lock:
+            self._check_workers()
+
+    def _check_workers(self):
+        cutoff = time.time() - self.worker_timeout
+        lost = set(worker_id for worker_id, seen in self.last_seen.items() if seen < cutoff)
+
+        if not lost:
+            return
+
+        for task_id, worker_id in list(self.assigned.items()):
+            if worker_id in lost:
+                del self.assigned[task_id]
+                self.pending.appendleft(task_id)
+
+        for worker_id in lost:
+            logger.warning("Worker {0} was lost, its chunks go to the others".format(worker_id))
+            del self.last_seen[worker_id]
+
+    def slot(self, worker_id, slots):
+        return self.slots.get(worker_id, 0) % slots
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    ####################################################
+    # Called by the workers
+    def get_settings(self):
+        return self.settings
+
+    def job_state(self):
+        """"running" or "stop", without taking a chunk (or counting as a
+        heartbeat), for workers that can't run this job """
+
+        with self.lock:
+            return "stop" if self.closed else "running"
+
+    def get_task(self, worker_id):
+        """("task", task id, task), ("wait",) when there's nothing to do
+        for now, or ("stop",) when the job is over """
+
+        with self.lock:
+            self._seen(worker_id)
+            self._check_workers()
+
+            if self.closed:
+                return ("stop",)
+
+            if not self.pending:
+                return ("wait",)
+
+            task_id = self.pending.popleft()
+            self.assigned[task_id] = worker_id
+
+            return ("task", task_id, self.tasks[task_id])
+
+    def heartbeat(self, worker_id):
+        with self.lock:
+            self._seen(worker_id)
+
+    def put_result(self, worker_id, task_id, result):
+        with self.lock:
+            self._seen(worker_id)
+
+            # Already back from another worker
+            if task_id not in self.tasks:
+                return
+
+            task = self.tasks.pop(task_id)
+            self.assigned.pop(task_id, None)
+
+            if task_id in self.pending:
+                self.pending.remove(task_id)
+
+        self.results.put((task_id, worker_id, task, result))
+
+    def put_error(self, worker_id, task_id, message):
+        with self.lock:
+            self._seen(worker_id)
+
+            # Already back from another worker, or gone back in the queue
+            # after this one was taken for lost (it'll fail there too, if
+            # it's going to)
+            if task_id not in self.tasks or self.assigned.get(task_id) != worker_id:
+                return
+
+        self.results.put((task_id, worker_id, None, WorkerError(message)))
+
+
+class DistributedScheduler(Scheduler):
+    def __init__(self, address, key, chunk_size=1000, settings=None, worker_timeout=30, slots=64):
+        """A Scheduler whose workers are the daemons that connect to
+        address. settings go to every worker before its first chunk:
+        "env" (env var -> value, None to unset it) and "globals"
+        (module -> {name: value}). Worker metrics are kept in slots
+        (one per worker, wrapping around) """
+
+        self.chunk_size = chunk_size
+        self.worker_count = slots
+
+        settings = dict(settings or {}, code_version=code_version())
+        self.coordinator = Coordinator(settings, worker_timeout)
+        self.metrics = metrics.WorkerMetrics(slots)
+
+        # A manager class of its own, since the registry is per class
+        manager_class = type("CoordinatorManager", (BaseManager,), {})
+        manager_class.register("coordinator", callable=lambda: self.coordinator, exposed=EXPOSED)
+
+        self.server = manager_class(address=address, authkey=key).get_server()
+        self.address = self.server.address
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        logger.info("Coordinator listening on {0}:{1}".format(*self.address))
+
+    def close(self):
+        self.coordinator.close()
+
+        # Long enough for the waiting workers to hear it's over
+        time.sleep(.5)
+
+        self.server.stop_event.set()
+        self.metrics.unlink()
+
+    def terminate(self):
+        self.close()
+
+    def imap_chunks(self, experiment, chunks, max_years, entropy, extra_args=()):
+        """Same as Scheduler.imap_chunks(), on the workers """
+
+        reference = _reference(experiment)
+        tasks = [((index, size), reference, size, max_years, seeding.chunk_seed(entropy, index)) + tuple(extra_args)
+                 for index, size in chunks]
+
+        remaining = set(self.coordinator.submit(tasks))
+        waiting_since = time.time()
+
+        while remaining:
+            try:
+                task_id, worker_id, task, result = self.coordinator.results.get(timeout=1)
+            except queue.Empty:
+                self.coordinator.check_workers()
+
+                if not self.coordinator.last_seen and time.time() - waiting_since > 10:
+                    logger.warning("No workers connected to {0}:{1} yet".format(*self.address))
+                    waiting_since = time.time()
+
+                continue
+
+            if isinstance(result, WorkerError):
+                raise RuntimeError("Chunk failed on worker {0}:\n{1}".format(worker_id, result))
+
+            remaining.discard(task_id)
+            self.metrics.add(self.coordinator.slot(worker_id, self.worker_count), "iterations", task[2])
+
+            yield task[0], result
+
+
+####################################################
+# The worker daemon
+def _apply_settings(settings, applied):
+    """Sets up this process for the job. Returns False if this
+    worker can't run it """
+
+    if settings["code_version"] != code_version():
+        logger.error("The coordinator runs different code, not taking its chunks")
+        return False
+
+    for name, value in settings.get("env", {}).items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    for module, values in settings.get("globals", {}).items():
+        for name, value in values.items():
+            setattr(importlib.import_module(module), name, value)
+
+    # The market data could come from another file now
+    if settings != applied:
+        market_data.reset()
+
+    return True
+
+
+def _heartbeat(coordinator, worker_id, interval, stop):
+    while not stop.wait(interval):
+        try:
+            coordinator.heartbeat(worker_id)
+        except (EOFError, OSError):
+            return
+
+
+def work(address, key, heartbeat_interval=5, retry_interval=2):
+    """Runs chunks for whatever coordinator is at address, forever """
+
+    # Ctrl-C is handled by serve(), which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    worker_id = "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+    applied = None
+
+    while True:
+        manager = _WorkerManager(address=address, authkey=key)
+
+        try:
+            manager.connect()
+        except OSError:
+            time.sleep(retry_interval)
+            continue
+
+        stop = threading.Event()
+
+        try:
+            coordinator = manager.coordinator()
+            settings = coordinator.get_settings()
+
+            if not _apply_settings(settings, applied):
+                # Wait for a coordinator with the same code (without
+                # taking chunks it would never run)
+                while coordinator.job_state() != "stop":
+                    time.sleep(retry_interval)
+                continue
+
+            applied = settings
+            logger.info("Worker {0} connected to {1}:{2}".format(worker_id, *address))
+
+            threading.Thread(target=_heartbeat, args=(coordinator, worker_id, heartbeat_interval, stop), daemon=True).start()
+
+            while True:
+                reply = coordinator.get_task(worker_id)
+
+                if reply[0] == "stop":
+                    break
+
+                if reply[0] == "wait":
+                    time.sleep(.1)
+                    continue
+
+                _, task_id, task = reply
+                experiment, args = _resolve(task[1]), task[2:]
+
+                try:
+                    result = experiment(*args)
+                except Exception:
+                    coordinator.put_error(worker_id, task_id, traceback.format_exc())
+                else:
+                    coordinator.put_result(worker_id, task_id, result)
+        except (EOFError, OSError):
+            logger.info("Lost the coordinator, waiting for the next one")
+        finally:
+            stop.set()
+
+        time.sleep(retry_interval)
+
+
+def serve(address, key, processes):
+    """Runs processes worker daemons until interrupted """
+
+    workers = [mp.Process(target=work, args=(address, key)) for _ in range(processes)]
+
+    for process in workers:
+        process.start()
+
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker daemons for a monte_carlo.py coordinator")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = subparsers.add_parser("worker", help="run chunks for the coordinator (COORDINATOR_AUTHKEY has to be set)")
+    worker_parser.add_argument("--coordinator", required=True, help="host:port of the coordinator")
+    worker_parser.add_argument("--processes", type=int, default=mp.cpu_count(), help="worker processes (default: one per CPU)")
+    worker_parser.add_argument("--module", default="monte_carlo", help="the module with the experiments (default: monte_carlo)")
+
+    args = parser.parse_args()
+
+    # Up front, so the workers inherit it (and its logging setup)
+    importlib.import_module(args.module)
+
+    serve(parse_address(args.coordinator), authkey(), args.processes)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Registry of the market data series (in percents).
+#
+# Every series is defined once here, or loaded from
+# MARKET_DATA_FILE (a .npz of arrays, or a .csv with
+# a column per series). They're picked by name with
+# these env vars:
+#
+#   INFLATION_SERIES        (default: inflation_normal,
+#                           or inflation_historical in
+#                           the joint SAMPLING modes)
+#   PROPERTY_GROWTH_SERIES  (default: grants_pass_property_growth)
+#   HISTORICAL_RETURNS      (default: vtinx)
+#   CONSERVATIVE_RETURNS    (default: vtinx)
+#
+# A series is only turned into an array the first
+# time it's used, and then kept for the life of the
+# process. The parent preloads what's selected
+# before the workers fork, so they inherit it.
+#
+# The "_normal" series aren't historical data: they
+# are drawn from a normal distribution with the same
+# mean and standard deviation, for every job.
+####################################################
+
+import csv
+import os
+
+import numpy as np
+
+import rate_sampler
+
+ROLES = {
+    "inflation_rates": ("INFLATION_SERIES", "inflation_normal"),
+    "property_growth_rates": ("PROPERTY_GROWTH_SERIES", "grants_pass_property_growth"),
+    "historical_returns": ("HISTORICAL_RETURNS", "vtinx"),
+    "conservative_returns": ("CONSERVATIVE_RETURNS", "vtinx"),
+}
+
+# The joint sampling modes line the series up by year, which
+# the generated ones don't have
+JOINT_DEFAULTS = {
+    "inflation_rates": "inflation_historical",
+}
+
+_EMBEDDED = {
+    ##############################
+    # Mean: 3.30396, STDev: 4.8447
+    "inflation_historical": [1.0, 1.0, 7.9, 17.4, 18.0, 14.6, 15.6, -10.5, -6.1, 1.8, 0.0, 2.3, 1.1, -1.7, -1.7,
+                             0.0, -2.3, -9.0, -9.9, -5.1, 3.1, 2.2, 1.5, 3.6, -2.1, -1.4, 0.7, 5.0, 10.9, 6.1,
+                             1.7, 2.3, 8.3, 14.4, 8.1, -1.2, 1.3, 7.9, 1.9, 0.8, 0.7, -0.4, 1.5, 3.3, 2.8, 0.7,
+                             1.7, 1.0, 1.0, 1.3, 1.3, 1.6, 2.9, 3.1, 4.2, 5.5, 5.7, 4.4, 3.2, 6.2, 11.0, 9.1,
+                             5.8, 6.5, 7.6, 11.3, 13.5, 10.3, 6.2, 3.2, 4.3, 3.6, 1.9, 3.6, 4.1, 4.8, 5.4, 4.2,
+                             3.0, 3.0, 2.6, 2.8, 3.0, 2.3, 1.6, 2.2, 3.4, 2.8, 1.6, 2.3, 2.7, 3.4, 3.2, 2.8,
+                             3.8, -0.4, 1.6, 3.2, 2.1, 1.5, 1.6],
+
+    # Inflation since 1983 - more realistic
+    # Mean: 2.72667, STDev: 1.30279
+    "inflation_since_1983": [0.73, 0.76, 1.50, 1.74, 2.96, 1.50, 2.72, 0.09, 4.08, 2.54, 3.42, 3.26, 1.88, 2.38,
+                             1.55, 3.39, 2.68, 1.61, 1.70, 3.32, 2.54, 2.67, 2.75, 2.90, 3.06, 6.11, 4.65, 4.42,
+                             4.43, 1.10, 3.80, 3.95, 3.79],
+
+    ######################################
+    # Grants pass propety assessment rates
+    # Mean: 2.87, STDev: 1.3945
+    "grants_pass_property_growth": [4.2, 2.8, 3.7, 2.0, 3.1, 1.1, 5.8, 2.2, 2.2, 1.6],
+
+    ###################################
+    # S&P 500 annual returns since 1970
+    # Mean: 11.842, STDev: 17.2141
+    "snp_500": [3.56, 14.22, 18.76, -14.31, -25.90, 37.00, 23.83, -6.98, 6.51, 18.52, 31.74,
+                -4.70, 20.42, 22.34, 6.15, 31.24, 18.49, 5.81, 16.54, 31.48, -3.06, 30.23,
+                7.49, 9.97, 1.33, 37.20, 22.68, 33.10, 28.34, 20.89, -9.03, -11.85, -21.97,
+                28.36, 10.74, 4.83, 15.61, 5.48, -36.55, 25.94, 14.82, 2.10, 15.89, 32.15, 13.48],
+
+    ###############################
+    # The wilshire 5000 index fund
+    # Mean: 12.3976, STDev: 16.6083
+    "wilshire_5000": [13.51, 32.18, 15.82, 1.97, 14.91, 26.49, -37.02, 5.39, 15.64, 4.77, 10.74,
+                      28.50, -22.15, -12.02, -9.06, 21.07, 28.62, 33.19, 22.88, 37.45, 1.18, 9.89,
+                      7.42, 30.22, -3.32, 31.36, 16.22, 4.71, 18.06, 31.23, 6.21, 21.29, 20.97,
+                      -5.21, 31.92, 18.05, 5.87, -7.84],
+
+    #############################
+    # Dow Jones, too
+    # Mean: 9.897, STDev: 15.2716
+    "djia": [38.32, 17.86, -17.27, -3.15, 4.19, 14.93, -9.23, 19.61, 20.27, -3.74, 27.66, 22.58,
+             2.26, 11.85, 26.96, -4.34, 20.32, 4.17, 13.72, 2.14, 33.45, 26.01, 22.64, 16.10,
+             25.22, -6.18, -7.10, -16.76, 25.32, 3.15, -0.61, 16.29, 6.43, -33.84, 18.82, 11.02,
+             5.53, 7.26, 26.50, 7.52],
+
+    ###############################
+    # And of course the nasdaq
+    # Mean: 14.4695, STDev: 25.2583
+    "nasdaq": [29.76, 26.10, 7.33, 12.31, 28.11, 33.88, -3.21, 18.67, 19.87, -11.22, 31.36, 7.36,
+               -5.26, 15.41, 19.26, -17.80, 56.84, 15.45, 14.75, -3.20, 39.92, 22.71, 21.64, 39.63,
+               85.59, -39.29, -21.05, -31.53, 50.01, 8.59, 1.37, 9.52, 9.81, -40.54, 43.89, 16.91,
+               -1.80, 15.91, 38.32, 13.40],
+
+    ########################################################
+    # A retirement fund recommended by USNews & World Report
+    # Mean: 5.18, STDev: 6.14295
+    "vtinx": [-0.17, 5.54, 5.87, 8.23, 5.25, 9.39, 14.28, -10.93, 8.17, 6.38, 3.33, 6.82],
+}
+
+# Name -> (mean, standard deviation), drawn max_years long
+_GENERATED = {
+    "inflation_normal": (2.72667, 1.30279),
+    "property_growth_normal": (2.87, 1.3945),
+    "snp_500_normal": (11.842, 17.2141),
+    "wilshire_5000_normal": (12.3976, 16.6083),
+    "djia_normal": (9.897, 15.2716),
+    "nasdaq_normal": (14.4695, 25.2583),
+    "vtinx_normal": (5.18, 6.14295),
+}
+
+# Series that have been materialized in this process
+_cache = dict()
+_file_series = None
+
+
+def _read_only(values):
+    array = np.array(values, dtype=np.float64)
+    array.setflags(write=False)
+
+    return array
+
+
+def _load_file(path):
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return {name: _read_only(data[name]) for name in data.files}
+
+    # A column per series, with the names in the first row. Shorter
+    # series just leave their cells empty.
+    with open(path, newline="") as fh:
+        rows = list(csv.reader(fh))
+
+    columns = dict()
+
+    for index, name in enumerate(rows[0]):
+        columns[name.strip()] = _read_only([float(row[index]) for row in rows[1:] if index < len(row) and row[index].strip()])
+
+    return columns
+
+
+def _file():
+    """The series in MARKET_DATA_FILE (loaded once) """
+
+    global _file_series
+
+    if _file_series is None:
+        path = os.environ.get("MARKET_DATA_FILE")
+        _file_series = _load_file(path) if path else dict()
+
+    return _file_series
+
+
+def names():
+    return sorted(set(_EMBEDDED) | set(_GENERATED) | set(_file()))
+
+
+def generated(name):
+    """Whether name is drawn for every job, instead of being historical data """
+
+    return name in _GENERATED
+
+
+def selection():
+    """Role (e.g. "historical_returns") -> series name, from the env vars """
+
+    defaults = {role: default for role, (_, default) in ROLES.items()}
+
+    if rate_sampler.sampling()[0] != "independent":
+        defaults.update(JOINT_DEFAULTS)
+
+    return {role: os.environ.get(env_var, defaults[role]) for role, (env_var, _) in ROLES.items()}
+
+
+def series(name, rng=None, max_years=None):
+    """The series (in percents) called name. The generated ones are drawn
+    from rng, max_years long, every time """
+
+    if name in _GENERATED:
+        mean, stdev = _GENERATED[name]
+
+        return rng.normal(mean, stdev, max_years)
+
+    if name not in _cache:
+        if name in _file():
+            _cache[name] = _file()[name]
+        elif name in _EMBEDDED:
+            _cache[name] = _read_only(_EMBEDDED[name])
+        else:
+            raise ValueError("Unknown market data series: {0} (there's {1})".format(name, ", ".join(names())))
+
+    return _cache[name]
+
+
+def reset():
+    """Forgets the series loaded so far (e.g. MARKET_DATA_FILE changed) """
+
+    global _file_series
+
+    _cache.clear()
+    _file_series = None
+
+
+def preload(selected=None):
+    """Materializes the selected series now (e.g. before forking workers) """
+
+    for name in (selected or selection()).values():
+        if name not in _GENERATED:
+            series(name)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Worker instrumentation.
+#
+# Every pool worker has a row of counters in shared
+# memory: runs done, and the seconds spent sampling
+# rates, simulating, and recording results. Workers
+# bump them as they go, and a thread in the parent
+# reads them to show a progress/ETA line and to write
+# a metrics snapshot (JSON, or Prometheus text format
+# for a node_exporter textfile collector).
+####################################################
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("iterations", "sampling", "simulate", "reporting", "started_at", "updated_at")
+PHASES = ("sampling", "simulate", "reporting")
+
+# This process's row (set up by attach_worker())
+_metrics = None
+_slot = 0
+
+
+class WorkerMetrics(object):
+    def __init__(self, slots, name=None):
+        """Creates a new block (name is None), or attaches to an existing one """
+
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=slots * len(FIELDS) * 8)
+        self.counters = np.ndarray((slots, len(FIELDS)), dtype=np.float64, buffer=self.shm.buf)
+
+        if name is None:
+            self.counters.fill(0)
+
+    @property
+    def spec(self):
+        return (self.shm.name, self.slots)
+
+    def add(self, slot, field, value):
+        row = self.counters[slot]
+        now = time.time()
+
+        if not row[FIELDS.index("started_at")]:
+            row[FIELDS.index("started_at")] = now
+
+        row[FIELDS.index(field)] += value
+        row[FIELDS.index("updated_at")] = now
+
+    def snapshot(self):
+        """The counters of every worker, as a list of dicts """
+
+        now = time.time()
+        workers = list()
+
+        for slot, row in enumerate(self.counters.copy()):
+            values = dict(zip(FIELDS, row.tolist()))
+            busy = now - values["started_at"] if values["started_at"] else 0
+
+            values["worker"] = slot
+            values["iterations_per_second"] = values["iterations"] / busy if busy else 0
+            values["seconds_since_update"] = now - values["updated_at"] if values["updated_at"] else None
+
+            workers.append(values)
+
+        return workers
+
+    def total_iterations(self):
+        return float(self.counters[:, FIELDS.index("iterations")].sum())
+
+    def close(self):
+        self.counters = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def attach_worker(spec, slot):
+    """Called once in each worker process """
+
+    global _metrics, _slot
+
+    name, slots = spec
+    _metrics = WorkerMetrics(slots, name=name)
+    _slot = slot
+
+
+def add_iterations(count):
+    if _metrics is not None:
+        _metrics.add(_slot, "iterations", count)
+
+
+def add_time(phase, seconds):
+    """Adds seconds to phase (one of PHASES) """
+
+    if _metrics is not None:
+        _metrics.add(_slot, phase, seconds)
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent in the block to phase """
+
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start_time)
+
+
+def to_prometheus(job, workers):
+    lines = [
+        "# HELP monte_carlo_progress_ratio Fraction of the runs that are done",
+        "# TYPE monte_carlo_progress_ratio gauge",
+        "monte_carlo_progress_ratio {0}".format(job["progress"]),
+        "# HELP monte_carlo_iterations_per_second Runs simulated per second, overall",
+        "# TYPE monte_carlo_iterations_per_second gauge",
+        "monte_carlo_iterations_per_second {0}".format(job["iterations_per_second"]),
+        "# HELP monte_carlo_worker_iterations_total Runs simulated by each worker",
+        "# TYPE monte_carlo_worker_iterations_total counter",
+    ]
+
+    for worker in workers:
+        lines.append('monte_carlo_worker_iterations_total{{worker="{0}"}} {1}'.format(worker["worker"], worker["iterations"]))
+
+    lines += [
+        "# HELP monte_carlo_worker_seconds_total Seconds each worker spent in each phase",
+        "# TYPE monte_carlo_worker_seconds_total counter",
+    ]
+
+    for worker in workers:
+        for phase in PHASES:
+            lines.append('monte_carlo_worker_seconds_total{{worker="{0}",phase="{1}"}} {2}'.format(worker["worker"], phase, worker[phase]))
+
+    lines += [
+        "# HELP monte_carlo_worker_seconds_since_update Seconds since each worker last reported",
+        "# TYPE monte_carlo_worker_seconds_since_update gauge",
+    ]
+
+    for worker in workers:
+        if worker["seconds_since_update"] is not None:
+            lines.append('monte_carlo_worker_seconds_since_update{{worker="{0}"}} {1}'.format(worker["worker"], worker["seconds_since_update"]))
+
+    return "\n".join(lines) + "\n"
+
+
+class ProgressReporter(object):
+    """Shows a progress/ETA line on stderr and/or writes metrics snapshots to
+    snapshot_path every interval seconds, until stopped. Snapshots are in
+    Prometheus text format if snapshot_path ends in .prom, JSON otherwise """
+
+    def __init__(self, metrics, total_runs, interval=1.0, show=True, snapshot_path=None, stall_seconds=30):
+        self.metrics = metrics
+        self.total_runs = total_runs
+        self.interval = interval
+        self.show = show
+        self.snapshot_path = snapshot_path
+        self.stall_seconds = stall_seconds
+
+        self.start_time = time.time()
+        self.start_iterations = metrics.total_iterations()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+        # One last update, with the final numbers
+        self.update()
+
+        if self.show:
+            sys.stderr.write("\n")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.update()
+            except Exception:
+                logger.exception("Couldn't update the progress metrics")
+
+    def job_stats(self, workers):
+        done = self.metrics.total_iterations() - self.start_iterations
+        elapsed = time.time() - self.start_time
+        rate = done / elapsed if elapsed else 0
+
+        return {
+            "runs_done": done,
+            "total_runs": self.total_runs,
+            "progress": min(done / self.total_runs, 1) if self.total_runs else 1,
+            "elapsed_seconds": elapsed,
+            "iterations_per_second": rate,
+            "eta_seconds": (self.total_runs - done) / rate if rate else None,
+            "stalled_workers": [worker["worker"] for worker in workers
+                                if worker["seconds_since_update"] is not None and worker["seconds_since_update"] > self.stall_seconds],
+        }
+
+    def update(self):
+        workers = self.metrics.snapshot()
+        job = self.job_stats(workers)
+
+        if self.show:
+            eta = "--:--" if job["eta_seconds"] is None else time.strftime("%H:%M:%S", time.gmtime(job["eta_seconds"]))
+            stalled = "  stalled workers: {0}".format(job["stalled_workers"]) if job["stalled_workers"] else ""
+
+            sys.stderr.write("\r{0:6.1%}  {1:,.0f}/{2:,} runs  {3:,.0f} iters/sec  ETA {4}{5}   ".format(
+                job["progress"], job["runs_done"], self.total_runs, job["iterations_per_second"], eta, stalled))
+            sys.stderr.flush()
+
+        if self.snapshot_path:
+            if self.snapshot_path.endswith(".prom"):
+                content = to_prometheus(job, workers)
+            else:
+                content = json.dumps({"job": job, "workers": workers}, indent=2)
+
+            # Write it somewhere else first, so a scraper never reads half a file
+            directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+            with os.fdopen(fd, "w") as fh:
+                fh.write(content)
+
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.snapshot_path)
@@ -11,17 +11,35 @@
 
 import locale
 import logging
-import math
 import os
-import signal
 import sys
 import time
+import uuid
 import multiprocessing as mp
 from collections import Counter, defaultdict
 from datetime import datetime
+from functools import partial
 import FinanceFuture as future
-
-from numpy import random
+import amortization
+import batch_engine as batch
+import checkpoint
+import distributed
+import market_data
+import metrics
+import outcome_sink
+import rate_sampler
+import seeding
+import shared_results
+import solver
+import sweep
+import tracing
+from convergence import ConvergenceMonitor, chi2_quantile, run_until_converged
+from distributed import DistributedScheduler
+from metrics import ProgressReporter
+from result_cache import CachedRunner, ResultCache, fingerprint
+from scheduler import Scheduler, worker_slot
+
+import numpy as np
 from tabulate import tabulate
 
 locale.setlocale(locale.LC_ALL, ('en_US', 'utf-8'))
@@ -34,22 +52,62 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 logger.addHandler(stream_handler)
 
-def run_experiment(iterations, max_years, output_queue, seed):
-    random.seed(seed)
-
-    def signal_handler(signal, frame):
-        sys.exit()
-
-    signal.signal(signal.SIGINT, signal_handler)
-
+########################################################
+# The scenario being modeled. Monthly amounts are in
+# today's dollars (they get adjusted for inflation).
+SCENARIO = {
+    # Starting at 21 years old
+    "birth_year": 1999,
+    "start_age": 21,
+    "retire_age": 67,
+
+    "investment_money": 1,
+    "pretax_salary": 55555,
+
+    "monthly_living_expenses": 888,
+    "monthly_petty_expenses": 222,
+
+    # Once retired
+    "retire_monthly_living_expenses": 1111,
+    "retire_monthly_petty_expenses": 88,
+
+    # Cashed out when I retire
+    "retirement_401k_base": 1111,
+    "retirement_401k_contribution": 11,
+
+    # Collected from ss_start_age until ss_end_age
+    "retire_ss_payment": 888,
+    "ss_start_age": 67,
+    "ss_end_age": 90,
+
+    # A loan of mortgage_principal taken out at mortgage_start_age, paid
+    # off over mortgage_years (0 = no mortgage). The payments are fixed,
+    # they don't go up with inflation. mortgage_rate_changes is
+    # {age: rate} for adjustable rates or refinancing from that age on
+    "mortgage_principal": 0,
+    "mortgage_rate": .045,
+    "mortgage_years": 30,
+    "mortgage_start_age": 30,
+    "mortgage_rate_changes": {},
+
+    "investment_withdraw_tax_rate": 0.20,
+    "income_tax_rate": .30,
+}
+
+# The env vars the experiments read, which distributed workers get
+# from the coordinator
+WORKER_ENV = ("BATCH_SIZE", "SAMPLING", "BLOCK_LENGTH", "VARIANCE_REDUCTION", "RISK_WINDOW_BEFORE", "RISK_WINDOW_AFTER",
+              "MARKET_DATA_FILE") + tuple(env_var for env_var, _ in market_data.ROLES.values())
+
+def run_experiment(iterations, max_years, seed):
     rel_years = defaultdict(int)
 
-    # Starting at 21 years old
-    birth_year = 1999
-    start_age = 21
-    retire_age = 67
+    birth_year = SCENARIO["birth_year"]
+    start_age = SCENARIO["start_age"]
+    retire_age = SCENARIO["retire_age"]
 
-    ff = future.FinanceFuture(max_years=max_years)
+    ff = future.FinanceFuture(max_years=max_years, rng=seeding.market_data_rng(seed))
+    ff.set_rng(seeding.chunk_rng(seed))
 
     # End year is just a arbitrary name for when a
     # epoch moment happens. In this case, it's for
@@ -59,174 +117,755 @@ def run_experiment(iterations, max_years, output_queue, seed):
 
     ########################################################
     # These don't change between iterations
-    ff.investment_withdraw_tax_rate = 0.20
-    ff.income_tax_rate = .30
+    ff.investment_withdraw_tax_rate = SCENARIO["investment_withdraw_tax_rate"]
+    ff.income_tax_rate = SCENARIO["income_tax_rate"]
+    ff.mortgage_payments = amortization.mortgage_payments(SCENARIO, max_years)
 
-    try:
-        for i in range(iterations):
-            table = list()
+    for i in range(iterations):
+        table = list()
 
-            # Init things
+        # Init things
+        with metrics.timed("sampling"):
             ff.shuffle_rates_and_returns()
 
-            # Reset for each scenario
-            ff.investment_money = 1
-            ff.pretax_salary = 55555
-
-            # These adjust for inflation
-            ff.monthly_living_expenses = 888 
-            ff.monthly_petty_expenses = 222 
-
-            retirement_401k_base = 1111
-            retire_ss_payment = 888
-
-            simulation_date = datetime(year=start_year, month=12, day=31)
-            stop_working_date = datetime(year=end_year, month=1, day=1)
-
-            ##################################################################
-            for rel_year in range(max_years):
-                note = ""
-
-                simulation_date = simulation_date.replace(year=start_year + rel_year)
-
-                # Retirement expenses
-                if simulation_date >= stop_working_date:
-                    # Thse are adjusted for inflation - use today's
-                    # amounts, not the future's
-                    ff.monthly_living_expenses = 1111
-                    ff.monthly_petty_expenses = 88 
-                    ff.pretax_salary = 0
-                else:
-                    retirement_401k_base += 11
-
-                ######################################################################################################
-                # Figure out income/expenses
-                yearly_income = ff.yearly_income(simulation_date, rel_year)
-                yearly_expenses = ff.yearly_expenses(simulation_date, rel_year)
-
-                # Collect SS now, baby! (stop once I hit 90)
-                if birth_year + 67 <= simulation_date.year <= birth_year + 90:
-                    yearly_income += retire_ss_payment * 12
-
-                    if simulation_date.year >= birth_year + 90:
-                        note = "* I'm probably dead (90 y.o.). No more SS money."
-                        retire_ss_payment = 0
-
-                net_income = yearly_income - yearly_expenses
-                ff.investment_money += net_income
-
-                ######################################################################################################
-                if simulation_date.year == end_year:
-                    note = "* I retire (401k cash-out of {0})".format(ff.dollar(retirement_401k_base))
-
-                    ff.pretax_salary = 0
-
-                    ff.historical_returns = ff.conservative_returns
-
-                    ff.investment_money += retirement_401k_base
-                    retirement_401k_base = 0
-                else:
-                    if retirement_401k_base:
-                        # Bump my 401k based on investment returns
-                        rate = ff.curr_conservative_rate(rel_year)
-                        retirement_401k_base = retirement_401k_base * (1 + rate)
-
-                if ff.investment_money <= 0:
-                    # print("out of money {0}".format(rel_year))
-                    note = "* OUT OF MONEY"
-
-                if not SIMULATE:
-                    table.append(
-                        [
-                            "{:>5s} {:>6s}".format(str(simulation_date.year), "({:+})".format(rel_year)),
-                            ff.dollar(yearly_income),
-                            ff.dollar(-yearly_expenses),
-                            "{0:>5s} / {1:>6s}".format(ff.pct(ff.curr_inflation_rate(rel_year)), ff.pct(ff.curr_investment_rate(rel_year))),
-                            ff.dollar(ff.orig_investment_money_afi(rel_year)),
-                            ff.pct(ff.pct_change(ff.investment_money, ff.orig_investment_money_afi(rel_year))),
-                            ff.dollar(ff.investment_money),
-                            note
-                        ])
-
-                if ff.investment_money <= 0:
-                    # Simulation failed
-                    break
-
-            if SIMULATE:
-                # I just want the last year when it 'died'
-                rel_years[rel_year] += 1
+        # Reset for each scenario
+        ff.investment_money = SCENARIO["investment_money"]
+        ff.pretax_salary = SCENARIO["pretax_salary"]
+
+        # These adjust for inflation
+        ff.monthly_living_expenses = SCENARIO["monthly_living_expenses"]
+        ff.monthly_petty_expenses = SCENARIO["monthly_petty_expenses"]
+
+        retirement_401k_base = SCENARIO["retirement_401k_base"]
+        retire_ss_payment = SCENARIO["retire_ss_payment"]
+
+        simulation_date = datetime(year=start_year, month=12, day=31)
+        stop_working_date = datetime(year=end_year, month=1, day=1)
+
+        ##################################################################
+        loop_start_time = time.perf_counter()
+
+        for rel_year in range(max_years):
+            note = ""
+
+            simulation_date = simulation_date.replace(year=start_year + rel_year)
+
+            # Retirement expenses
+            if simulation_date >= stop_working_date:
+                # Thse are adjusted for inflation - use today's
+                # amounts, not the future's
+                ff.monthly_living_expenses = SCENARIO["retire_monthly_living_expenses"]
+                ff.monthly_petty_expenses = SCENARIO["retire_monthly_petty_expenses"]
+                ff.pretax_salary = 0
+            else:
+                retirement_401k_base += SCENARIO["retirement_401k_contribution"]
+
+            ######################################################################################################
+            # Figure out income/expenses
+            yearly_income = ff.yearly_income(simulation_date, rel_year)
+            yearly_expenses = ff.yearly_expenses(simulation_date, rel_year)
+
+            # Collect SS now, baby! (stop once I hit 90)
+            if birth_year + SCENARIO["ss_start_age"] <= simulation_date.year <= birth_year + SCENARIO["ss_end_age"]:
+                yearly_income += retire_ss_payment * 12
+
+                if simulation_date.year >= birth_year + SCENARIO["ss_end_age"]:
+                    note = "* I'm probably dead (90 y.o.). No more SS money."
+                    retire_ss_payment = 0
+
+            net_income = yearly_income - yearly_expenses
+            ff.investment_money += net_income
+
+            ######################################################################################################
+            if simulation_date.year == end_year:
+                note = "* I retire (401k cash-out of {0})".format(ff.dollar(retirement_401k_base))
+
+                ff.pretax_salary = 0
+
+                ff.historical_returns = ff.conservative_returns
+
+                ff.investment_money += retirement_401k_base
+                retirement_401k_base = 0
+            else:
+                if retirement_401k_base:
+                    # Bump my 401k based on investment returns
+                    rate = ff.curr_conservative_rate(rel_year)
+                    retirement_401k_base = retirement_401k_base * (1 + rate)
+
+            if ff.investment_money <= 0:
+                # print("out of money {0}".format(rel_year))
+                note = "* OUT OF MONEY"
+
+            if not SIMULATE:
+                table.append(
+                    [
+                        "{:>5s} {:>6s}".format(str(simulation_date.year), "({:+})".format(rel_year)),
+                        ff.dollar(yearly_income),
+                        ff.dollar(-yearly_expenses),
+                        "{0:>5s} / {1:>6s}".format(ff.pct(ff.curr_inflation_rate(rel_year)), ff.pct(ff.curr_investment_rate(rel_year))),
+                        ff.dollar(ff.orig_investment_money_afi(rel_year)),
+                        ff.pct(ff.pct_change(ff.investment_money, ff.orig_investment_money_afi(rel_year))),
+                        ff.dollar(ff.investment_money),
+                        note
+                    ])
+
+            if ff.investment_money <= 0:
+                # Simulation failed
+                break
+
+        metrics.add_time("simulate", time.perf_counter() - loop_start_time)
+
+        if SIMULATE:
+            # I just want the last year when it 'died'
+            rel_years[rel_year] += 1
+        else:
+            rel_years = table
+
+        metrics.add_iterations(1)
+    return rel_years
+
+
+def run_batch_experiment(iterations, max_years, seed):
+    """Same as run_experiment() in SIMULATE mode, but each block of
+    BATCH_SIZE runs is simulated as one set of NumPy arrays """
+    return run_sweep_experiment(iterations, max_years, seed, [SCENARIO])[0]
+
+
+def run_sweep_experiment(iterations, max_years, seed, scenarios):
+    """run_batch_experiment() for several scenarios, all on the same
+    rate paths. Returns a failure Counter for each scenario """
+    rel_years = [Counter() for _ in scenarios]
+
+    for batch_fail_years in _batch_failure_years(iterations, max_years, seed, scenarios):
+        with metrics.timed("reporting"):
+            for cnt, fail_years in zip(rel_years, batch_fail_years):
+                cnt.update(batch.failure_histogram(fail_years))
+
+    return rel_years
+
+
+def run_batch_trajectories(iterations, max_years, seed, sink_spec):
+    """run_batch_experiment(), that also writes the yearly numbers of
+    every run to the outcome sink (at the chunk's run offset) """
+    rel_years = Counter()
+
+    sink = outcome_sink.open_sink(sink_spec)
+    run_offset = seeding.chunk_index(seed) * sink_spec["chunk_size"]
+
+    for paths in _rate_path_batches(iterations, max_years, seed):
+        with metrics.timed("simulate"):
+            detail = batch.trajectories(SCENARIO, max_years, paths)
+
+        with metrics.timed("reporting"):
+            sink.write(run_offset, detail)
+            rel_years.update(batch.failure_histogram(batch.failure_years(detail["investment_money"])))
+
+        run_offset += len(detail["investment_money"])
+
+    return rel_years
+
+
+def run_batch_shared(iterations, max_years, seed, shared_spec):
+    """run_batch_experiment(), but the results are added to the shared
+    memory aggregates (at this worker's slot) instead of returned """
+    aggregates = shared_results.attach(shared_spec)
+    slot = worker_slot()
+
+    for paths in _rate_path_batches(iterations, max_years, seed):
+        with metrics.timed("simulate"):
+            balances = batch.simulate(SCENARIO, max_years, paths)
+
+        with metrics.timed("reporting"):
+            aggregates.add(slot, batch.failure_years(balances), balances)
+
+
+def run_traced_experiment(iterations, max_years, seed, trace_spec):
+    """run_batch_experiment(), that also keeps the yearly numbers of a
+    random sample of the runs and of the worst ones (see tracing.py).
+    Returns the failure Counter and the chunk's TraceCollector """
+    sample_size, worst_size, chunk_size, job = trace_spec
+
+    rel_years = Counter()
+    traces = tracing.TraceCollector(sample_size, worst_size)
+    seen = tracing.seen(job, sample_size, worst_size)
+
+    rng = seeding.trace_rng(seed)
+    run_offset = seeding.chunk_index(seed) * chunk_size
+
+    for paths in _rate_path_batches(iterations, max_years, seed):
+        with metrics.timed("simulate"):
+            balances = batch.simulate(SCENARIO, max_years, paths)
+
+        with metrics.timed("reporting"):
+            fail_years = batch.failure_years(balances)
+            rel_years.update(batch.failure_histogram(fail_years))
+
+            traces.offer(run_offset, balances, fail_years, rng.random(len(balances)),
+                         lambda rows: batch.trajectories(SCENARIO, max_years, {name: matrix[rows] for name, matrix in paths.items()}),
+                         seen=seen)
+
+        run_offset += len(balances)
+
+    return rel_years, traces
+
+
+def run_checkpointed_experiment(iterations, max_years, seed, checkpoint_spec):
+    """run_batch_experiment(), picking the runs up at retirement from
+    the chunk's checkpoint (see checkpoint.py) """
+    return run_checkpointed_sweep(iterations, max_years, seed, [SCENARIO], checkpoint_spec)[0]
+
+
+def run_checkpointed_sweep(iterations, max_years, seed, scenarios, checkpoint_spec):
+    """run_sweep_experiment(), picking the runs up at retirement from the
+    chunk's checkpoint. If there isn't one yet, the working years are
+    simulated and saved first. The scenarios can only differ in what
+    happens after retiring """
+    store = checkpoint.open_store(checkpoint_spec)
+    index = seeding.chunk_index(seed)
+
+    # Without a checkpoint yet, the working years are simulated and saved.
+    # Either way, the rates are sampled again from the chunk's seed
+    state = store.load(index, iterations)
+    states = list() if state is None else None
+
+    rel_years = [Counter() for _ in scenarios]
+    offset = 0
+
+    for paths in _rate_path_batches(iterations, max_years, seed, scenarios[0]):
+        runs = len(paths["historical_returns"])
+
+        with metrics.timed("simulate"):
+            if states is None:
+                batch_state = checkpoint.rows(state, offset, offset + runs)
             else:
-                rel_years = table
-    except:
-        # This traps the sys.exit()
-        raise
+                batch_state = batch.retirement_state(scenarios[0], max_years, paths)
+                states.append(batch_state)
+
+            fail_years = [batch.resume_failure_years(scenario, max_years, batch_state, paths) for scenario in scenarios]
+
+        with metrics.timed("reporting"):
+            for cnt, batch_fail_years in zip(rel_years, fail_years):
+                cnt.update(batch.failure_histogram(batch_fail_years))
+
+        offset += runs
+
+    if states is not None:
+        store.save(index, iterations, checkpoint.concatenate(states))
+
+    return rel_years
+
+
+def run_solver_paths(iterations, max_years, seed, paths_spec):
+    """Samples the chunk's rate paths into the solver's shared block """
+    shared = solver.attach(paths_spec)
+    rows = shared.rows(seed, iterations)
+    offset = rows.start
+
+    for paths in _rate_path_batches(iterations, max_years, seed):
+        shared.store(offset, paths)
+        offset += len(paths["historical_returns"])
+
+
+def run_solver_evaluation(iterations, max_years, seed, paths_spec, parameter, values, horizon):
+    """How many of the chunk's runs last horizon years with the scenario's
+    parameter set to each of values (on the paths in the solver's shared
+    block), and how many runs that took simulating """
+    shared = solver.attach(paths_spec)
+    rows = shared.rows(seed, iterations)
+
+    counts = list()
+    simulated = 0
+
+    for value in values:
+        scenario = dict(SCENARIO)
+        scenario[parameter] = value
+
+        with metrics.timed("simulate"):
+            count, runs = shared.evaluate(rows, parameter, value, partial(batch.survivors, scenario, horizon))
+
+        counts.append(count)
+        simulated += runs
+
+    metrics.add_iterations(simulated)
 
-    output_queue.put(rel_years)
+    return counts, simulated
+
+
+def _batch_failure_years(iterations, max_years, seed, scenarios):
+    """Yields, for every block of BATCH_SIZE runs, the failure years
+    for each of the scenarios """
+    for paths in _rate_path_batches(iterations, max_years, seed, scenarios[0]):
+        with metrics.timed("simulate"):
+            fail_years = [batch.failure_years(batch.simulate(scenario, max_years, paths)) for scenario in scenarios]
+
+        yield fail_years
+
+
+def _rate_path_batches(iterations, max_years, seed, scenario=None):
+    """Yields the rate paths for every block of BATCH_SIZE runs. The
+    variance reduction stratifies around scenario's (default: SCENARIO's)
+    retirement """
+    batch_size = int(os.environ.get("BATCH_SIZE", 10000))
+    scenario = scenario or SCENARIO
+
+    ff = future.FinanceFuture(max_years=max_years, rng=seeding.market_data_rng(seed))
+    ff.set_rng(seeding.chunk_rng(seed))
+    ff.sampler.risk_window = rate_sampler.risk_window(scenario["retire_age"] - scenario["start_age"])
+
+    for offset in range(0, iterations, batch_size):
+        runs = min(batch_size, iterations - offset)
+
+        with metrics.timed("sampling"):
+            paths = ff.sampler.sample(runs)
+
+        yield paths
+
+        # The batch is done once the caller asks for the next one
+        metrics.add_iterations(runs)
+
+
+def success_table(cnt, success_rate, std_errors=None):
+    """Rows of [relative year, failures, success %, standard error] for
+    the years where the success rate is still at least success_rate.
+    std_errors are by year; without them, the runs are taken to be
+    independent (which overstates it for the variance reduction) """
+    table = list()
+
+    total_count = 0
+    runs = sum(cnt.values())
+
+    for year, count in reversed(sorted(cnt.items())):
+        total_count += count
+        pct = total_count / runs
+
+        if pct >= success_rate:
+            std_error = std_errors[year] if std_errors is not None else np.sqrt(pct * (1 - pct) / runs)
+
+            # Meaning, it's successful, so add it.
+            table.insert(0, [year, count, "{:>.2%}".format(pct), "{:>.3%}".format(std_error)])
+
+    return table
+
+
+def effective_runs(cnt, success_rate, std_errors, batches, confidence):
+    """The range of how many independent runs it'd take to get the same
+    standard error at the last year in the report (at confidence), and
+    that year. The standard errors are from only as many batches as there
+    are, so a single number would be a lot more precise than it is """
+    table = success_table(cnt, success_rate)
+
+    if not table:
+        return None, None
+
+    year = table[-1][0]
+    pct = sum(count for fail_year, count in cnt.items() if fail_year >= year) / sum(cnt.values())
+
+    if not std_errors[year] or pct >= 1:
+        return None, year
+
+    # The batch variance has batches - 1 degrees of freedom
+    equivalent_runs = pct * (1 - pct) / std_errors[year] ** 2
+    dof = batches - 1
+
+    return (equivalent_runs * chi2_quantile((1 - confidence) / 2, dof) / dof,
+            equivalent_runs * chi2_quantile((1 + confidence) / 2, dof) / dof), year
+
+
+def make_scheduler(worker_count, chunk_size, profile_path=None):
+    """A pool of local workers, or with COORDINATOR=host:port, the worker
+    daemons that connect there (see distributed.py) """
+
+    address = os.environ.get("COORDINATOR")
+
+    if not address:
+        return Scheduler(worker_count=worker_count, chunk_size=chunk_size, profile_path=profile_path)
+
+    # What the experiments read outside of their arguments
+    settings = {
+        "env": {name: os.environ.get(name) for name in WORKER_ENV},
+        "globals": {"monte_carlo": {"SCENARIO": SCENARIO, "SIMULATE": True}},
+    }
+
+    return DistributedScheduler(distributed.parse_address(address), distributed.authkey(), chunk_size=chunk_size,
+                                settings=settings, worker_timeout=float(os.environ.get("WORKER_TIMEOUT", 30)))
+
+
+def solve_scenario(parameter, runs, max_years, entropy, success_rate, worker_count, chunk_size):
+    """Prints the value of the scenario's parameter that just meets
+    success_rate (see solver.py) """
+    horizon = min(int(os.environ.get("SOLVE_YEARS", max_years)), max_years)
+    confidence = float(os.environ.get("CONFIDENCE", .95))
+
+    start_time = time.time()
+    shared = solver.SharedPaths(runs, max_years, chunk_size)
+
+    try:
+        with Scheduler(worker_count=worker_count, chunk_size=chunk_size) as scheduler:
+            search = solver.Solver(scheduler, run_solver_evaluation, shared, parameter, SCENARIO.get(parameter),
+                                   runs, max_years, entropy, horizon,
+                                   limits=(SCENARIO["start_age"], SCENARIO["start_age"] + horizon),
+                                   points=int(os.environ.get("SOLVE_POINTS", 8)),
+                                   tolerance=float(os.environ.get("SOLVE_TOLERANCE", 1)))
+
+            # Every value gets tried on these same paths
+            for _ in scheduler.imap(run_solver_paths, runs, max_years, entropy, extra_args=(shared.spec,)):
+                pass
+
+            sampled_time = time.time()
+
+            results = search.solve(success_rate, ConvergenceMonitor(max_years, success_rate, confidence=confidence).z)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, workers stopped")
+        sys.exit(130)
+    finally:
+        shared.unlink()
+
+    elapsed_time = time.time() - start_time
+
+    def show(value):
+        if value is None:
+            return "none"
+
+        if parameter == "retire_age":
+            return str(value)
+
+        return locale.currency(value, grouping=True)
+
+    goal = "highest" if search.goal == "max" else "lowest"
+    band = sorted(value for value in (results["conservative"], results["optimistic"]) if value is not None)
+
+    print("#")
+    print("# Solve For: {0} ({1} that gets {2:.0%} of the runs through {3} years)".format(parameter, goal, success_rate, horizon))
+    print("# Monte Carlo Runs: {0}\n# Run Time: {1:0.3f} seconds ({2:0.3f} sampling)".format(
+        locale.format_string("%.*f", (0, runs), True), elapsed_time, sampled_time - start_time))
+    print("# Values Tried: {0} in {1} passes\n# Runs Simulated: {2} ({3:.1%} of trying every value on every run)".format(
+        len(search.counts), search.passes, locale.format_string("%.*f", (0, search.simulated), True),
+        search.simulated / (len(search.counts) * runs)))
+    print("#")
+
+    table = [
+        ["Answer", show(results["answer"])],
+        ["{0:.0%} Confidence Band".format(confidence), " - ".join(show(value) for value in band) if band else "none"],
+        ["Currently", show(SCENARIO[parameter])],
+    ]
+
+    print(tabulate(table, stralign="right"))
+
+    print("\n* The answer is the {goal} {parameter} where at least {pct:.0%} of the runs\n"
+          "  never run out of money, all of them on the same rate paths. The band\n"
+          "  is where the true success rate could still be {pct:.0%}, given the number\n"
+          "  of runs. \"none\" means no value got there.".format(goal=goal, parameter=parameter, pct=success_rate))
+
+
+def fan_chart_table(aggregates, pcts, step):
+    """Headers and rows of the balance percentiles, every step years """
+    percentiles = aggregates.balance_percentiles(pcts)
+    mean, _ = aggregates.balance_stats()
+
+    headers = ["Relative Year"] + ["{0:g}th %".format(pct) for pct in pcts] + ["Mean"]
+    years = sorted(set(range(0, aggregates.max_years, step)) | {aggregates.max_years - 1})
+
+    table = [[year] + [locale.currency(value, grouping=True) for value in percentiles[year]] +
+             [locale.currency(mean[year], grouping=True)] for year in years]
+
+    return headers, table
 
 
 if __name__ == "__main__":
     max_years = int(os.environ.get("MAX_YEARS", 100))
+
+    # Same seed (and CHUNK_SIZE) = same results, with any number of workers
+    entropy = seeding.master_entropy(os.environ.get("MASTER_SEED"))
+    logger.info("MASTER_SEED={0}".format(entropy))
+
     SIMULATE = False
     SIMULATE = True
 
-    output_queue = mp.Queue()
-
     if SIMULATE:
-        table = list()
-        cnt = Counter()
-
         runs = int(os.environ.get("RUNS", 10000))
         success_rate = float(os.environ.get("LOWER_PCT", .96))
-        worker_count = mp.cpu_count()
+        worker_count = int(os.environ.get("WORKERS", mp.cpu_count()))
+        chunk_size = int(os.environ.get("CHUNK_SIZE", 1000))
+
+        # "batch" simulates blocks of runs as arrays, "loop" is
+        # the original run-by-run, year-by-year simulation
+        engine = os.environ.get("ENGINE", "batch")
+        experiment = run_batch_experiment if engine == "batch" else run_experiment
+
+        # VARIANCE_REDUCTION works across the runs of a batch
+        if rate_sampler.variance_reduction() != "none" and engine != "batch":
+            raise ValueError("VARIANCE_REDUCTION needs ENGINE=batch")
+
+        # Workers inherit the market data instead of each loading it
+        market_data.preload()
+
+        # The joint modes only sample the years every simulated series has
+        if rate_sampler.sampling()[0] != "independent":
+            rates = future.FinanceFuture(max_years=max_years, rng=seeding.market_data_rng(seeding.chunk_seed(entropy, 0)))
+            logger.info("SAMPLING={0}: {1} historical years line up across {2}".format(
+                rate_sampler.sampling()[0], rates.sampler.history_years,
+                ", ".join(rates.series[role] for role in future.SIMULATED_SERIES)))
+
+        # SOLVE_FOR=<SCENARIO key> finds the value of it that just meets
+        # LOWER_PCT, instead of reporting on the scenario as is
+        if os.environ.get("SOLVE_FOR"):
+            # The workers share the rate paths through shared memory
+            if os.environ.get("COORDINATOR"):
+                raise ValueError("SOLVE_FOR only runs on local workers (unset COORDINATOR)")
+
+            solve_scenario(os.environ["SOLVE_FOR"], runs, max_years, entropy, success_rate, worker_count, chunk_size)
+            sys.exit(0)
 
         # Do the monte-carlo simulation
         # http://www.cfiresim.com/docs/faq.php#investigate
-        iterations_per_cpu = math.ceil(runs / float(worker_count))
+        start_time = time.time()
 
-        def signal_handler(signal, frame):
-            pass
+        # With CONVERGE=1, RUNS is the most runs to do, and it stops once
+        # the last year above LOWER_PCT is known within TOLERANCE years
+        converge = os.environ.get("CONVERGE", "0") == "1"
+        stop_reason = None
+
+        # A JSON/YAML file of scenarios to run side by side (see sweep.py)
+        sweep_file = os.environ.get("SWEEP_FILE")
+        scenarios = sweep.load_scenarios(sweep_file, SCENARIO) if sweep_file else [("", SCENARIO)]
+        counters = None
+
+        # OUTCOME_SINK=memmap|npy writes every run's yearly numbers to OUTCOME_PATH
+        sink_format = None if sweep_file else os.environ.get("OUTCOME_SINK")
+
+        if sink_format:
+            sink_spec = outcome_sink.create(sink_format, os.environ.get("OUTCOME_PATH", "outcomes.npy"), runs, max_years, chunk_size)
+            experiment = partial(run_batch_trajectories, sink_spec=sink_spec)
+
+        # CHECKPOINT_DIR (up to CHECKPOINT_MAX_MB) keeps every run's state going
+        # into retirement, so jobs that only change the retirement years, or
+        # that got interrupted, pick up from there. Needs MASTER_SEED, too
+        checkpoint_dir = os.environ.get("CHECKPOINT_DIR")
+        use_checkpoint = checkpoint_dir and os.environ.get("MASTER_SEED") and engine == "batch" and not sink_format
+        sweep_experiment = run_sweep_experiment
+
+        if use_checkpoint:
+            working = checkpoint.accumulation_scenario(scenarios[0][1])
+
+            if any(checkpoint.accumulation_scenario(scenario) != working for _, scenario in scenarios):
+                raise ValueError("With CHECKPOINT_DIR, the scenarios can only change what happens after retiring")
+
+            rates = future.FinanceFuture(max_years=max_years, rng=seeding.market_data_rng(seeding.chunk_seed(entropy, 0)))
+            checkpoints = checkpoint.CheckpointStore(
+                checkpoint_dir,
+                fingerprint(working=working, market_data=rates.sampler.base_rates, engine_version=batch.VERSION,
+                            max_years=max_years, seed=entropy, chunk_size=chunk_size,
+                            batch_size=int(os.environ.get("BATCH_SIZE", 10000)),
+                            sampling=rate_sampler.sampling(),
+                            variance_reduction=rate_sampler.variance_reduction(),
+                            risk_window=rate_sampler.risk_window(working["retire_age"] - working["start_age"])),
+                max_bytes=int(os.environ.get("CHECKPOINT_MAX_MB", 2048)) * 2 ** 20)
+
+            logger.info("Checkpoints: {0} chunks saved in {1}".format(checkpoints.saved_chunks(), checkpoints.directory))
+
+            experiment = partial(run_checkpointed_experiment, checkpoint_spec=checkpoints.spec)
+            sweep_experiment = partial(run_checkpointed_sweep, checkpoint_spec=checkpoints.spec)
+
+        # Results are cached in CACHE_DIR (up to CACHE_MAX_MB), but only if
+        # MASTER_SEED is set - otherwise every job is different anyway
+        cache_dir = os.environ.get("CACHE_DIR")
+        use_cache = cache_dir and os.environ.get("MASTER_SEED") and not sweep_file and not sink_format
+
+        if use_cache:
+            cache = ResultCache(cache_dir, max_bytes=int(os.environ.get("CACHE_MAX_MB", 512)) * 2 ** 20)
+
+            # The rates actually used (so picking other series is a different key)
+            rates = future.FinanceFuture(max_years=max_years, rng=seeding.market_data_rng(seeding.chunk_seed(entropy, 0)))
+            cache_key = fingerprint(scenario=SCENARIO, market_data=rates.sampler.base_rates,
+                                    engine=engine, engine_version=batch.VERSION, max_years=max_years,
+                                    seed=entropy, chunk_size=chunk_size,
+                                    batch_size=int(os.environ.get("BATCH_SIZE", 10000)),
+                                    sampling=rate_sampler.sampling(),
+                                    variance_reduction=rate_sampler.variance_reduction(),
+                                    risk_window=rate_sampler.risk_window(SCENARIO["retire_age"] - SCENARIO["start_age"]))
+
+        # TRACE_SAMPLE random runs and the TRACE_WORST worst ones get their
+        # yearly numbers kept, for the report and TRACE_FILE
+        trace_spec = (int(os.environ.get("TRACE_SAMPLE", 0)), int(os.environ.get("TRACE_WORST", 0)), chunk_size, uuid.uuid4().hex)
+        use_trace = any(trace_spec[:2])
+
+        if use_trace:
+            if engine != "batch" or sweep_file or sink_format or use_cache or use_checkpoint:
+                raise ValueError("TRACE_SAMPLE/TRACE_WORST need ENGINE=batch, without SWEEP_FILE, OUTCOME_SINK, CACHE_DIR or CHECKPOINT_DIR")
+
+            experiment = run_traced_experiment
+            traces = tracing.TraceCollector(*trace_spec[:2])
+
+        # The batch engine's results go through shared memory, unless
+        # SHARED_RESULTS=0 (or another mode needs them per chunk, or
+        # the workers are on other hosts)
+        use_shared = (engine == "batch" and os.environ.get("SHARED_RESULTS", "1") == "1"
+                      and not (sweep_file or sink_format or use_cache or use_checkpoint or use_trace or os.environ.get("COORDINATOR")))
+        aggregates = None
+
+        if use_shared:
+            experiment = run_batch_shared
+            aggregates = shared_results.SharedAggregates(worker_count, max_years)
+
+        # A live progress/ETA line on stderr (PROGRESS=1/0, on by default for
+        # a terminal), and METRICS_FILE gets a snapshot of the worker metrics
+        # (Prometheus text format if it ends in .prom, JSON otherwise)
+        show_progress = os.environ.get("PROGRESS", "1" if sys.stderr.isatty() else "0") == "1"
+
+        # A job that's all in the cache doesn't need any workers (with
+        # CONVERGE, it isn't known yet how many runs that would be)
+        cnt = cache.lookup(cache_key, runs, chunk_size) if use_cache and not converge else None
+        from_cache = cnt is not None
+        fan_chart = std_errors = None
+        batches = 0
+        simulated_runs = None
+
+        if not from_cache:
+            try:
+                # PROFILE=file.prof runs one of the (local) workers under cProfile
+                with make_scheduler(worker_count, chunk_size, profile_path=os.environ.get("PROFILE")) as scheduler, \
+                        ProgressReporter(scheduler.metrics, runs, interval=float(os.environ.get("PROGRESS_INTERVAL", 1)),
+                                         show=show_progress, snapshot_path=os.environ.get("METRICS_FILE")):
+                    if use_cache:
+                        scheduler = CachedRunner(scheduler, cache, cache_key)
+                    elif use_trace:
+                        scheduler = tracing.TraceRunner(scheduler, traces, trace_spec)
+                    elif use_shared:
+                        scheduler = shared_results.SharedRunner(scheduler, aggregates)
+
+                    if sweep_file:
+                        counters = sweep.run_sweep(scheduler, sweep_experiment, scenarios, runs, max_years, entropy)
+                    elif converge:
+                        monitor = ConvergenceMonitor(max_years, success_rate,
+                                                     tolerance=int(os.environ.get("TOLERANCE", 1)),
+                                                     confidence=float(os.environ.get("CONFIDENCE", .95)))
+
+                        time_budget = os.environ.get("TIME_BUDGET")
+                        time_budget = float(time_budget) if time_budget else None
+
+                        cnt, stop_reason = run_until_converged(scheduler, experiment, max_years, entropy, monitor,
+                                                               max_runs=runs,
+                                                               round_size=int(os.environ.get("ROUND_SIZE", 10000)),
+                                                               time_budget=time_budget)
+                    else:
+                        cnt = scheduler.run(experiment, runs, max_years, entropy)
+
+                    if use_cache:
+                        simulated_runs = scheduler.simulated
+
+                # The shared results have the numbers to get the standard errors
+                # from the spread between batches (which is what counts with the
+                # variance reduction)
+                std_errors = aggregates.success_std_errors() if aggregates is not None else None
+                batches = aggregates.batch_count() if aggregates is not None else 0
+
+                # FAN_CHART=1 adds the balance percentiles (needs the shared results)
+                if aggregates is not None and os.environ.get("FAN_CHART", "0") == "1":
+                    fan_pcts = [float(pct) for pct in os.environ.get("FAN_PERCENTILES", "5,25,50,75,95").split(",")]
+                    fan_chart = fan_chart_table(aggregates, fan_pcts, int(os.environ.get("FAN_STEP", 5)))
+            except KeyboardInterrupt:
+                logger.warning("Interrupted, workers stopped")
+                sys.exit(130)
+            finally:
+                if aggregates is not None:
+                    aggregates.unlink()
 
-        signal.signal(signal.SIGINT, signal_handler)
+        elapsed_time = time.time() - start_time
 
-        # Flatten the list
-        start_time = time.time()
+        if use_checkpoint:
+            checkpoints.evict()
 
-        for i in range(worker_count):
-            mp.Process(target=run_experiment, args=(iterations_per_cpu, max_years, output_queue, random.randint(0, 2 ** 32))).start()
+        if counters is None:
+            counters = [cnt]
 
-        for i in range(worker_count):
-            cnt.update(output_queue.get())
+        # Every scenario does the same number of runs
+        runs = sum(counters[0].values())
 
-        elapsed_time = time.time() - start_time
+        if simulated_runs is None:
+            simulated_runs = 0 if from_cache else runs * len(scenarios)
 
-        total_count = 0
-        runs = sum(cnt.values())
+        if sink_format:
+            outcome_sink.finish(sink_spec, runs, max_years)
 
-        for year, count in reversed(sorted(cnt.items())):
-            total_count += count
-            pct = total_count / runs
+        print("#")
+        print("# Monte Carlo Runs: {0}\n# Run Time: {1:0.3f} seconds".format(locale.format_string("%.*f", (0, runs), True), elapsed_time))
 
-            if pct >= success_rate:
-                # Meaning, it's successful, so add it.
-                table.insert(0, [year, count, "{:>.2%}".format(pct)])
+        # Only what was simulated counts for the rate
+        if simulated_runs:
+            print("# Iters/Sec: {0:0.3f}".format(simulated_runs / elapsed_time))
+
+        if simulated_runs < runs * len(scenarios):
+            print("# From the result cache: {0}".format(locale.format_string("%.*f", (0, runs * len(scenarios) - simulated_runs), True)))
+
+        if stop_reason:
+            earliest, latest = monitor.cutoff_range(cnt)
+            print("# Stopped: {0} (last year above {1:.0%} is {2}-{3} at {4:.0%} confidence)".format(
+                stop_reason, success_rate, earliest, latest, monitor.confidence))
+
+        # The standard errors are only shown with VARIANCE_REDUCTION (where
+        # they're what tells it worked), or with STD_ERRORS=1
+        show_std_errors = rate_sampler.variance_reduction() != "none" or os.environ.get("STD_ERRORS", "0") == "1"
+
+        if show_std_errors and std_errors is not None:
+            confidence = float(os.environ.get("CONFIDENCE", .95))
+            equivalent_runs, year = effective_runs(cnt, success_rate, std_errors, batches, confidence)
+
+            if equivalent_runs:
+                print("# Effective Runs: {0} to {1} (independent runs for the same standard error at year {2}, "
+                      "at {3:.0%} confidence from {4} batches)".format(
+                          *[locale.format_string("%.*f", (0, count), True) for count in equivalent_runs],
+                          year, confidence, batches))
 
-        print("#")
-        print("# Monte Carlo Runs: {0}\n# Run Time: {1:0.3f} seconds\n# Iters/Sec: {2:0.3f}".format(locale.format_string("%.*f", (0, runs), True), elapsed_time,
-                                                                                                    runs / elapsed_time))
         print("#")
 
-        headers = ["Relative Year", "Failures", "Success Confidence %"]
-        print(tabulate(table, headers=headers, stralign="right"))
+        headers = ["Relative Year", "Failures", "Success Confidence %", "Std. Error"]
+        columns = len(headers) if show_std_errors else len(headers) - 1
+
+        for (name, _), cnt in zip(scenarios, counters):
+            if name:
+                print("\n## Scenario: {0}".format(name))
+
+            print(tabulate([row[:columns] for row in success_table(cnt, success_rate, std_errors)],
+                           headers=headers[:columns], stralign="right"))
 
         print("\n* This report stops at what year the simulation success rate drops\n"
               "  below {pct:.0%}, or if it goes past {years} years. The last 'relative year'\n"
               "  column is the year when your defined scenario conditions cause\n"
               "  you to run out of money (the failure condition).".format(pct=success_rate, years=max_years))
 
+        if show_std_errors:
+            print("\n* The standard error is for the success confidence %{0}.".format(
+                ", from the spread between batches of runs" if std_errors is not None else ", taking the runs to be independent"))
+
+        if use_trace:
+            traced = traces.traces()
+            print("\n## Traced Runs\n")
+            headers, table = tracing.summary_table(traced)
+            print(tabulate(table, headers=headers, stralign="right"))
+
+            # TRACE_SHOW of them get their yearly numbers printed, worst first
+            start_year = SCENARIO["birth_year"] + SCENARIO["start_age"]
+
+            for record in (traced["worst"] + traced["sample"])[:int(os.environ.get("TRACE_SHOW", 1))]:
+                headers, table = tracing.run_table(record, start_year)
+
+                print("\n### Run {0}\n".format(record["run"]))
+                print(tabulate(table, headers=headers, stralign="right"))
+
+            if os.environ.get("TRACE_FILE"):
+                tracing.export(os.environ["TRACE_FILE"], traced)
+                logger.info("Traces written to {0}".format(os.environ["TRACE_FILE"]))
+
+        if fan_chart:
+            print("\n## Investment Money Percentiles\n")
+            print(tabulate(fan_chart[1], headers=fan_chart[0], stralign="right"))
+
+            print("\n* Balances are at the end of each relative year, counting runs that\n"
+                  "  ran out of money as $0. The mean only counts runs that still had money.")
+
     else:
         # This is for debugging if you want to see more details
-        run_experiment(iterations=1, max_years=max_years, output_queue=output_queue, seed=random.randint(0, 2 ** 32))
-        table = output_queue.get()
+        table = run_experiment(iterations=1, max_years=max_years, seed=seeding.chunk_seed(entropy, 0))
 
         headers = ["Year", "Income", "Expenses", "Inf./Int. (%)", "Orig Asset AGI",
                     "Asset Value (AGI)", "Investment Money", "Note"]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Writes every run's yearly numbers (investment
+# money, income, expenses, inflation) to disk as the
+# workers produce them, instead of holding them in
+# memory or sending them back through the pool.
+#
+# "memmap": one preallocated .npy file of shape
+#   (runs, fields, max_years). Each chunk owns the
+#   rows at its run offset, and workers write them
+#   in place.
+# "npy": one .npy file per chunk of runs, in a
+#   directory, named by the chunk's run offset.
+#
+# Either way, a .json file next to it lists the
+# fields, and how many runs were written.
+####################################################
+
+import json
+import os
+
+import numpy as np
+
+FIELDS = ("investment_money", "yearly_income", "yearly_expenses", "inflation_rate")
+DTYPE = np.float32
+
+
+def _meta_path(path):
+    return os.path.splitext(path.rstrip(os.sep))[0] + ".json"
+
+
+def create(fmt, path, runs, max_years, chunk_size):
+    """Sets up the sink in the parent process. Returns the spec the
+    workers use to open it (see open_sink()) """
+
+    if fmt == "memmap":
+        np.lib.format.open_memmap(path, mode="w+", dtype=DTYPE, shape=(runs, len(FIELDS), max_years)).flush()
+    elif fmt == "npy":
+        os.makedirs(path, exist_ok=True)
+    else:
+        raise ValueError("Unknown outcome sink format: {0} (use memmap or npy)".format(fmt))
+
+    return {"format": fmt, "path": path, "chunk_size": chunk_size}
+
+
+def finish(spec, runs, max_years):
+    """Records what ended up in the sink """
+
+    meta = {"format": spec["format"], "fields": FIELDS, "runs": runs, "max_years": max_years,
+            "dtype": np.dtype(DTYPE).name, "shape": "(runs, fields, max_years)"}
+
+    with open(_meta_path(spec["path"]), "w") as fh:
+        json.dump(meta, fh, indent=2)
+
+
+class MemmapSink(object):
+    def __init__(self, path):
+        self.outcomes = np.load(path, mmap_mode="r+")
+
+    def write(self, offset, detail):
+        runs = len(detail[FIELDS[0]])
+
+        for field_index, field in enumerate(FIELDS):
+            self.outcomes[offset:offset + runs, field_index, :] = detail[field]
+
+        self.outcomes.flush()
+
+
+class NpyChunkSink(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, offset, detail):
+        block = np.stack([detail[field] for field in FIELDS], axis=1).astype(DTYPE)
+
+        np.save(os.path.join(self.path, "runs_{0:012d}.npy".format(offset)), block)
+
+
+def open_sink(spec):
+    if spec["format"] == "memmap":
+        return MemmapSink(spec["path"])
+
+    return NpyChunkSink(spec["path"])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Streaming percentiles of the portfolio balance.
+#
+# Balances go into fixed histogram bins, one set of
+# bins per relative year, so the memory used doesn't
+# depend on the number of runs, and two sketches are
+# merged by adding their counts.
+#
+# The bins are evenly spaced on a signed log scale
+# (sign(x) * log10(1 + |x|)), which gives about the
+# same relative precision for $100 as for $10M.
+####################################################
+
+import numpy as np
+
+
+class HistogramSketch(object):
+    def __init__(self, low_decades=6, high_decades=12, bins_per_decade=40):
+        """Covers balances from -10^low_decades to 10^high_decades. Anything
+        outside of that lands in the first/last bin """
+
+        self.low = -float(low_decades)
+        self.high = float(high_decades)
+        self.bins = int((low_decades + high_decades) * bins_per_decade)
+
+    @staticmethod
+    def _scale(values):
+        return np.sign(values) * np.log10(1 + np.abs(values))
+
+    @staticmethod
+    def _unscale(scaled):
+        return np.sign(scaled) * (10 ** np.abs(scaled) - 1)
+
+    def bin_index(self, values):
+        scaled = self._scale(values)
+        index = np.floor((scaled - self.low) / (self.high - self.low) * self.bins).astype(np.int64)
+
+        return np.clip(index, 0, self.bins - 1)
+
+    def counts(self, values):
+        """Bins a (runs, years) matrix. Returns (years, bins) counts """
+
+        years = values.shape[1]
+        flat_index = self.bin_index(values) + np.arange(years) * self.bins
+
+        return np.bincount(flat_index.ravel(), minlength=years * self.bins).reshape(years, self.bins)
+
+    def quantiles(self, counts, pcts):
+        """The pcts (0-100) percentiles for every row of counts, interpolated
+        within the bins. Returns a (years, len(pcts)) matrix """
+
+        width = (self.high - self.low) / self.bins
+        result = np.full((counts.shape[0], len(pcts)), np.nan)
+
+        for year, year_counts in enumerate(counts):
+            total = year_counts.sum()
+
+            if not total:
+                continue
+
+            cumulative = np.cumsum(year_counts)
+
+            for column, pct in enumerate(pcts):
+                rank = pct / 100 * total
+                index = min(np.searchsorted(cumulative, rank), self.bins - 1)
+
+                below = cumulative[index] - year_counts[index]
+                fraction = (rank - below) / year_counts[index] if year_counts[index] else 0
+
+                result[year, column] = self._unscale(self.low + (index + fraction) * width)
+
+        # The bins around 0 are only cents wide, so anything in them
+        # is just 0 that got interpolated
+        result[np.abs(result) < 1] = 0
+
+        return result
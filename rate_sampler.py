@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Draws the shuffled rate paths the simulation runs
+# on. The base series are kept as contiguous float64
+# arrays, and a whole batch of runs is drawn at once.
+#
+# SAMPLING picks how:
+#   independent - every series is permuted on its own
+#                 (argsort of random keys), per run.
+#                 The original behavior (default).
+#   bootstrap   - the years of each run are drawn
+#                 from the history with replacement
+#   permutation - the years of each run are shuffled
+#                 passes through the whole history
+#   block       - moving-block bootstrap: runs of
+#                 BLOCK_LENGTH consecutive years
+#                 (default: 5) from random places
+#                 in the history
+#
+# The last three are joint: one matrix of historical
+# year indices is drawn per batch, and every series is
+# gathered from it, so inflation and returns from the
+# same year stay together (and the RNG only has to do
+# runs x years of work, not runs x years x series).
+#
+# VARIANCE_REDUCTION spreads the runs of a batch out
+# more evenly than independent draws would, so the
+# results settle down with fewer runs:
+#   none        - plain random draws (default)
+#   antithetic  - every other run is the mirror image
+#                 of the one before it: each draw is
+#                 swapped for the one at the opposite
+#                 rank (the best year for the worst,
+#                 and so on)
+#   stratified  - the years in the risk window around
+#                 retirement (where a bad sequence of
+#                 returns hurts the most) are Latin
+#                 hypercube samples across the batch
+#   sobol       - the draws come from a scrambled Sobol
+#                 sequence (needs scipy), with the risk
+#                 window getting the first dimensions
+#
+# Stratified and sobol need a mode that draws with
+# replacement (bootstrap or block). In the joint modes,
+# years are ranked by their real return (the average
+# of the two returns, less inflation).
+####################################################
+
+import os
+import warnings
+
+import numpy as np
+
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+MODES = ("independent", "bootstrap", "permutation", "block")
+VARIANCE_REDUCTION = ("none", "antithetic", "stratified", "sobol")
+
+
+def sampling():
+    """The (mode, block length) from SAMPLING and BLOCK_LENGTH """
+
+    mode = os.environ.get("SAMPLING", "independent")
+    block_length = int(os.environ.get("BLOCK_LENGTH", 5))
+
+    if mode not in MODES:
+        raise ValueError("Unknown SAMPLING: {0} (use one of {1})".format(mode, ", ".join(MODES)))
+
+    if block_length < 1:
+        raise ValueError("BLOCK_LENGTH has to be at least 1")
+
+    return mode, block_length
+
+
+def variance_reduction():
+    """The strategy from VARIANCE_REDUCTION """
+
+    strategy = os.environ.get("VARIANCE_REDUCTION", "none")
+
+    if strategy not in VARIANCE_REDUCTION:
+        raise ValueError("Unknown VARIANCE_REDUCTION: {0} (use one of {1})".format(strategy, ", ".join(VARIANCE_REDUCTION)))
+
+    return strategy
+
+
+def risk_window(retire_year):
+    """The relative years [start, stop) around retire_year to stratify,
+    from RISK_WINDOW_BEFORE (default: 2) and RISK_WINDOW_AFTER (default: 8) """
+
+    before = int(os.environ.get("RISK_WINDOW_BEFORE", 2))
+    after = int(os.environ.get("RISK_WINDOW_AFTER", 8))
+
+    return max(0, retire_year - before), retire_year + after
+
+
+def _mirror(indices, order):
+    """Swaps every index for the one at the opposite rank in order """
+
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+
+    return order[len(order) - 1 - ranks[indices]]
+
+
+def _lhs_column(rng, runs):
+    """One Latin hypercube column: a draw from each 1/runs slice of [0, 1) """
+
+    return (rng.permutation(runs) + rng.random(runs)) / runs
+
+
+class RateSampler(object):
+    def __init__(self, base_rates, rng, mode="independent", block_length=5, path_length=None,
+                 variance_reduction="none", risk_window=None, year_scores=None):
+        """base_rates is a dict of series name -> rates (as fractions,
+        not percents). rng is the numpy.random.Generator to draw from.
+
+        In the joint modes, the series have to line up: one rate per
+        historical year, the same years in the same order. Each run
+        gets path_length years (default: the length of the history).
+
+        year_scores ranks the historical years for the variance
+        reduction (higher is better, default: the mean of the series),
+        and risk_window is the [start, stop) relative years to
+        stratify """
+
+        self.rng = rng
+        self.mode = mode
+        self.block_length = block_length
+        self.variance_reduction = variance_reduction
+        self.risk_window = risk_window
+        self.base_rates = dict()
+
+        for name, rates in base_rates.items():
+            self.base_rates[name] = np.ascontiguousarray(rates, dtype=np.float64)
+
+        if variance_reduction in ("stratified", "sobol") and mode not in ("bootstrap", "block"):
+            raise ValueError("VARIANCE_REDUCTION={0} needs SAMPLING=bootstrap or block".format(variance_reduction))
+
+        if variance_reduction == "sobol" and qmc is None:
+            raise RuntimeError("scipy is needed for VARIANCE_REDUCTION=sobol")
+
+        if mode != "independent":
+            lengths = set(len(rates) for rates in self.base_rates.values())
+
+            if len(lengths) != 1:
+                raise ValueError("Joint sampling needs series of the same length (got {0})".format(sorted(lengths)))
+
+            self.history_years = lengths.pop()
+            self.path_length = path_length or self.history_years
+
+            # A block can't be longer than the history
+            self.block = min(block_length, self.history_years)
+
+            if year_scores is None:
+                year_scores = np.mean(list(self.base_rates.values()), axis=0)
+
+            # What gets drawn (years, or the first year of a block), worst to best
+            scores = np.asarray(year_scores, dtype=np.float64)
+
+            if mode == "block":
+                scores = np.convolve(scores, np.ones(self.block), "valid")
+
+            self.unit_order = np.argsort(scores, kind="stable")
+
+    def permuted(self, name, runs):
+        """Returns a (runs, len(series)) matrix where every row is
+        an independent permutation of the base series """
+
+        base = self.base_rates[name]
+
+        if self.variance_reduction == "antithetic":
+            half = self.rng.random((-(-runs // 2), len(base)))
+            order = np.argsort(half, axis=1)
+
+            return base[np.concatenate((order, _mirror(order, np.argsort(base, kind="stable"))))[:runs]]
+
+        keys = self.rng.random((runs, len(base)))
+
+        return base[np.argsort(keys, axis=1)]
+
+    def _units(self):
+        """How many draws there are per run, and the ones (columns) in
+        the risk window """
+
+        if self.mode == "block":
+            columns = -(-self.path_length // self.block)
+            start, stop = self.risk_window or (0, 0)
+
+            return columns, range(min(start // self.block, columns), min(-(-stop // self.block), columns))
+
+        start, stop = self.risk_window or (0, 0)
+
+        return self.path_length, range(min(start, self.path_length), min(stop, self.path_length))
+
+    def _uniforms(self, runs, columns, window):
+        """(runs, columns) of draws in [0, 1), stratified or quasi-random """
+
+        if self.variance_reduction == "sobol":
+            # The first dimensions of a Sobol sequence are the most even
+            column_order = list(window) + [column for column in range(columns) if column not in window]
+            sobol = qmc.Sobol(d=columns, scramble=True, seed=self.rng)
+
+            # It's only perfectly balanced for 2^n runs, but that's fine
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                points = sobol.random(runs)
+
+            uniforms = np.empty_like(points)
+            uniforms[:, column_order] = points
+
+            return uniforms
+
+        uniforms = self.rng.random((runs, columns))
+
+        for column in window:
+            uniforms[:, column] = _lhs_column(self.rng, runs)
+
+        return uniforms
+
+    def _draw_units(self, runs):
+        """(runs, draws) of years (or block starts) """
+
+        years = self.history_years
+        length = self.path_length
+
+        if self.variance_reduction in ("stratified", "sobol"):
+            columns, window = self._units()
+            count = len(self.unit_order)
+            ranks = np.minimum((self._uniforms(runs, columns, window) * count).astype(np.int64), count - 1)
+
+            return self.unit_order[ranks]
+
+        if self.mode == "bootstrap":
+            return self.rng.integers(0, years, (runs, length))
+
+        if self.mode == "permutation":
+            # As many shuffled passes through the history as it takes
+            passes = -(-length // years)
+            keys = self.rng.random((runs, passes, years))
+
+            return np.argsort(keys, axis=2).reshape(runs, passes * years)[:, :length]
+
+        return self.rng.integers(0, years - self.block + 1, (runs, -(-length // self.block)))
+
+    def year_indices(self, runs):
+        """Returns a (runs, path_length) matrix of the historical years
+        (indices into the series) every run uses """
+
+        if self.variance_reduction == "antithetic":
+            half = self._draw_units(-(-runs // 2))
+            units = np.concatenate((half, _mirror(half, self.unit_order)))[:runs]
+        else:
+            units = self._draw_units(runs)
+
+        if self.mode != "block":
+            return units
+
+        return (units[:, :, np.newaxis] + np.arange(self.block)).reshape(runs, -1)[:, :self.path_length]
+
+    def sample(self, runs):
+        """Returns a dict of (runs, years) matrices: one for each
+        series, and a "cascaded_" one with its compounded rates
+        (1 + r0, (1 + r0) * (1 + r1), ...) """
+
+        paths = dict()
+        indices = None if self.mode == "independent" else self.year_indices(runs)
+
+        for name, base in self.base_rates.items():
+            rates = self.permuted(name, runs) if indices is None else base[indices]
+
+            paths[name] = rates
+            paths["cascaded_" + name] = np.cumprod(1 + rates, axis=1)
+
+        return paths
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+####################################################
+# On-disk cache of simulation results.
+#
+# Results are keyed by a fingerprint of everything
+# that goes into them: the scenario, the base rate
+# series, the engine (and its version), MAX_YEARS,
+# the master seed and how the runs are chunked. They
+# are stored per chunk, so asking for more runs than
+# are cached only simulates the missing chunks.
+#
+# Each key is one compressed .npz file. When the
+# cache gets bigger than its size limit, the least
+# recently used files are removed.
+####################################################
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+from scheduler import chunk_sizes
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical(value):
+    if isinstance(value, np.ndarray):
+        return {"dtype": str(value.dtype), "shape": value.shape,
+                "sha256": hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}
+
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def fingerprint(**parts):
+    """A hex digest of parts (anything JSON-able, plus numpy arrays) """
+
+    blob = json.dumps(_canonical(parts), sort_keys=True, default=str)
+
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, path, max_bytes=512 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def load(self, key):
+        """Returns the cached chunks for key, as a dict of
+        (chunk index, chunk size) -> failure counts by year """
+
+        path = self._file(key)
+        chunks = dict()
+
+        try:
+            with np.load(path) as data:
+                for index, size, counts in zip(data["indices"], data["sizes"], data["counts"]):
+                    chunks[(int(index), int(size))] = counts
+        except FileNotFoundError:
+            return chunks
+
+        # Mark it as recently used
+        os.utime(path)
+
+        return chunks
+
+    def store(self, key, chunks):
+        """Saves chunks (same shape as what load() returns) for key """
+
+        ordered = sorted(chunks)
+        arrays = {
+            "indices": np.array([index for index, _ in ordered], dtype=np.int64),
+            "sizes": np.array([size for _, size in ordered], dtype=np.int64),
+            "counts": np.array([chunks[chunk] for chunk in ordered], dtype=np.int64),
+        }
+
+        # Write it somewhere else first so readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as fh:
+            np.savez_compressed(fh, **arrays)
+
+        os.replace(tmp_path, self._file(key))
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes """
+
+        entries = list()
+
+        for name in os.listdir(self.path):
+            if name.endswith(".npz"):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            logger.debug("Evicting {0} from the result cache".format(name))
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def lookup(self, key, runs, chunk_size, start_chunk=0):
+        """The failure Counter for runs, if every chunk of them is cached
+        (None otherwise) """
+
+        cached = self.load(key)
+        wanted = _chunks(runs, chunk_size, start_chunk)
+
+        if any(chunk not in cached for chunk in wanted):
+            return None
+
+        logger.info("Result cache: all {0} chunks cached".format(len(wanted)))
+
+        return _merged(cached, wanted)
+
+
+def _chunks(runs, chunk_size, start_chunk):
+    return [(index, size) for index, size in enumerate(chunk_sizes(runs, chunk_size), start_chunk)]
+
+
+def _merged(cached, wanted):
+    """The failure Counter for the wanted chunks """
+
+    counts = np.sum([cached[chunk] for chunk in wanted], axis=0, dtype=np.int64)
+    years = np.flatnonzero(counts)
+
+    return Counter(dict(zip(years.tolist(), counts[years].tolist())))
+
+
+class CachedRunner(object):
+    """Stands in for a Scheduler's run(), but only simulates the chunks
+    that aren't in the cache yet """
+
+    def __init__(self, scheduler, cache, key):
+        self.scheduler = scheduler
+        self.cache = cache
+        self.key = key
+
+        self.chunk_size = scheduler.chunk_size
+        # The runs that weren't in the cache
+        self.simulated = 0
+
+    def run(self, experiment, runs, max_years, entropy, start_chunk=0):
+        cached = self.cache.load(self.key)
+        wanted = _chunks(runs, self.chunk_size, start_chunk)
+        missing = [chunk for chunk in wanted if chunk not in cached]
+
+        logger.info("Result cache: {0} of {1} chunks cached".format(len(wanted) - len(missing), len(wanted)))
+
+        for chunk, result in self.scheduler.imap_chunks(experiment, missing, max_years, entropy):
+            counts = np.zeros(max_years, dtype=np.int64)
+
+            for year, count in result.items():
+                counts[year] = count
+
+            cached[chunk] = counts
+            self.simulated += chunk[1]
+
+        if missing:
+            self.cache.store(self.key, cached)
+
+        return _merged(cached, wanted)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Hands out the monte carlo runs to a pool of worker
+# processes in small chunks. Workers pull the next
+# chunk as soon as they finish one, so a slow worker
+# doesn't hold up the rest, and the chunks add up to
+# exactly the number of runs asked for.
+####################################################
+
+import cProfile
+import logging
+import multiprocessing as mp
+import os
+import signal
+from collections import Counter
+
+import metrics
+import seeding
+
+logger = logging.getLogger(__name__)
+
+# Which of the pool's workers this process is (0 outside of a pool)
+_worker_slot = 0
+
+# Set in the one worker that's being profiled
+_profiler = None
+_profile_path = None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _claim_slot(slot_owners):
+    """The first slot without a live worker (by pid). When a worker dies,
+    the pool replaces it, and the new one takes over its slot """
+
+    with slot_owners.get_lock():
+        for slot, pid in enumerate(slot_owners):
+            if not pid or not _alive(pid):
+                slot_owners[slot] = os.getpid()
+                return slot
+
+    raise RuntimeError("No free worker slot (more workers than worker_count?)")
+
+
+def _init_worker(slot_owners, metrics_spec, profile_path):
+    global _worker_slot, _profiler, _profile_path
+
+    # Ctrl-C is handled by the parent, which tears down the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _worker_slot = _claim_slot(slot_owners)
+    assert _worker_slot < len(slot_owners)
+
+    metrics.attach_worker(metrics_spec, _worker_slot)
+
+    if profile_path and _worker_slot == 0:
+        _profiler = cProfile.Profile()
+        _profile_path = profile_path
+
+
+def worker_slot():
+    """A number from 0 to worker_count - 1 that's unique to this worker,
+    for indexing per-worker buffers """
+
+    return _worker_slot
+
+
+def _run_task(task):
+    chunk, experiment, args = task[0], task[1], task[2:]
+
+    if _profiler is None:
+        return chunk, experiment(*args)
+
+    result = _profiler.runcall(experiment, *args)
+
+    # Stats so far (they add up over all of this worker's chunks)
+    _profiler.dump_stats(_profile_path)
+
+    return chunk, result
+
+
+def chunk_sizes(runs, chunk_size):
+    """Splits runs into chunks of at most chunk_size that add up
+    to exactly runs """
+
+    full_chunks, remainder = divmod(runs, chunk_size)
+    sizes = [chunk_size] * full_chunks
+
+    if remainder:
+        sizes.append(remainder)
+
+    return sizes
+
+
+class Scheduler(object):
+    def __init__(self, worker_count=None, chunk_size=1000, profile_path=None):
+        """If profile_path is set, one of the workers runs its experiments
+        under cProfile, and saves the stats there (see pstats) """
+
+        self.worker_count = worker_count or mp.cpu_count()
+        self.chunk_size = chunk_size
+
+        self.metrics = metrics.WorkerMetrics(self.worker_count)
+
+        # The pid of the worker in each slot (0 for none yet)
+        self.slot_owners = mp.Array("i", self.worker_count)
+        self.pool = mp.Pool(self.worker_count, initializer=_init_worker,
+                            initargs=(self.slot_owners, self.metrics.spec, profile_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.metrics.unlink()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.metrics.unlink()
+
+    def imap_chunks(self, experiment, chunks, max_years, entropy, extra_args=()):
+        """Yields ((chunk index, chunk size), result) for each chunk as it
+        comes back (in no particular order). experiment is called as
+        experiment(chunk size, max_years, seed, *extra_args) in a worker
+        process, where seed is the chunk's SeedSequence """
+
+        tasks = [((index, size), experiment, size, max_years, seeding.chunk_seed(entropy, index)) + tuple(extra_args)
+                 for index, size in chunks]
+
+        for chunk, result in self.pool.imap_unordered(_run_task, tasks):
+            yield chunk, result
+
+    def submit_chunk(self, experiment, chunk, max_years, entropy, callback, error_callback, extra_args=()):
+        """Runs one chunk ((index, size)) without waiting for it. Then
+        callback(chunk, result), or error_callback(exception), gets called
+        from one of the pool's threads """
+
+        index, size = chunk
+        task = (chunk, experiment, size, max_years, seeding.chunk_seed(entropy, index)) + tuple(extra_args)
+
+        self.pool.apply_async(_run_task, (task,), callback=lambda chunk_result: callback(*chunk_result),
+                              error_callback=error_callback)
+
+    def imap(self, experiment, runs, max_years, entropy, start_chunk=0, extra_args=()):
+        """Splits runs into chunks and yields each chunk's result as it
+        comes back (see imap_chunks()).
+
+        start_chunk is the index of the first chunk, to continue a job
+        that already did start_chunk chunks """
+
+        chunks = list(enumerate(chunk_sizes(runs, self.chunk_size), start_chunk))
+
+        for _, result in self.imap_chunks(experiment, chunks, max_years, entropy, extra_args):
+            yield result
+
+    def run(self, experiment, runs, max_years, entropy, start_chunk=0):
+        """Runs the experiment, and merges the failure year counts
+        from all of the chunks """
+
+        cnt = Counter()
+
+        for rel_years in self.imap(experiment, runs, max_years, entropy, start_chunk):
+            cnt.update(rel_years)
+
+        return cnt
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Random number streams for a simulation job.
+#
+# Everything comes from one master seed (MASTER_SEED).
+# The market data (the base rate series) gets its own
+# stream, and every chunk of runs gets an independent
+# stream keyed by the chunk's index. Which worker runs
+# a chunk doesn't matter, so the same seed gives the
+# same results with any number of workers. Picking runs
+# to trace has its own streams too, so turning it on
+# doesn't change the runs.
+####################################################
+
+from numpy.random import SeedSequence, default_rng
+
+MARKET_DATA_KEY = 0
+CHUNK_KEY = 1
+TRACE_KEY = 2
+
+
+def master_entropy(seed=None):
+    """The master seed as an int. A fresh one is generated if
+    seed is None (log it to be able to reproduce the job) """
+
+    if seed is None:
+        return SeedSequence().entropy
+
+    return int(seed)
+
+
+def chunk_seed(entropy, index):
+    """The SeedSequence for the chunk at index. It's the same as the
+    index'th child spawned from the chunk key, but doesn't depend on
+    how many chunks were spawned before it """
+
+    return SeedSequence(entropy, spawn_key=(CHUNK_KEY, index))
+
+
+def chunk_index(seed):
+    """The index of the chunk a chunk_seed() belongs to """
+
+    return seed.spawn_key[-1]
+
+
+def chunk_rng(seed):
+    return default_rng(seed)
+
+
+def market_data_rng(seed):
+    """The market data stream for the job a chunk seed belongs to """
+
+    return default_rng(SeedSequence(seed.entropy, spawn_key=(MARKET_DATA_KEY,)))
+
+
+def trace_rng(seed):
+    """The stream for picking which runs of a chunk to trace """
+
+    return default_rng(SeedSequence(seed.entropy, spawn_key=(TRACE_KEY, chunk_index(seed))))
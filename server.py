@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+####################################################
+# Simulations as a service.
+#
+# Running monte_carlo.py per query pays for starting
+# Python, importing NumPy and forking the workers
+# every time. This keeps one pool of workers (and the
+# market data) warm, and takes the jobs over HTTP, on
+# a port or a Unix socket:
+#
+#   POST /simulate  {"scenario": {...}, "runs": 10000,
+#                    "seed": 42, "max_years": 100,
+#                    "success_rate": .96}
+#
+# Everything is optional: "scenario" only needs what
+# differs from SCENARIO, and the rest defaults to
+# RUNS, MAX_YEARS, LOWER_PCT (and a fresh seed). The
+# reply is a stream of JSON lines, each with the
+# success table for the runs done so far. The last
+# one has "done": true.
+#
+#   GET /status     the jobs running, and the workers
+#
+# The workers take chunks round-robin from the jobs
+# that are running, and only as many chunks as there
+# are workers are handed out at a time. So a small job
+# doesn't wait behind a big one, and each job gets an
+# even share of the workers.
+#
+# A request for the same scenario, runs, seed and
+# years as a job that's still running joins it instead
+# of starting another one. A job nobody is listening
+# to anymore is dropped.
+####################################################
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import os
+import signal
+import time
+from collections import Counter, deque
+
+import market_data
+import monte_carlo
+import seeding
+from result_cache import fingerprint
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+HEADERS = ["Relative Year", "Failures", "Success Confidence %", "Std. Error"]
+
+# Biggest request body taken (in bytes)
+MAX_BODY = 2 ** 20
+
+# Most runs and years a request can ask for (see --max-runs, --max-years)
+MAX_RUNS = 10 ** 7
+MAX_YEARS = 200
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class RequestError(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, key, scenario, runs, max_years, entropy, chunk_size):
+        self.key = key
+        self.scenario = scenario
+        self.runs = runs
+        self.max_years = max_years
+        self.entropy = entropy
+        self.chunk_size = chunk_size
+
+        # The chunks are made as they're handed out (the same ones as
+        # chunk_sizes()), so a big job doesn't take memory up front
+        self.next_chunk = 0
+        self.runs_handed_out = 0
+        self.cnt = Counter()
+        self.runs_done = 0
+        self.in_flight = 0
+
+        self.listeners = 0
+        self.cancelled = False
+        self.error = None
+        self.started_at = time.time()
+
+        # Set (and replaced) every time there's news
+        self.updated = asyncio.Event()
+
+    @property
+    def has_chunks(self):
+        return not self.cancelled and self.error is None and self.runs_handed_out < self.runs
+
+    def take_chunk(self):
+        """The next (index, size) to run """
+
+        chunk = (self.next_chunk, min(self.chunk_size, self.runs - self.runs_handed_out))
+
+        self.next_chunk += 1
+        self.runs_handed_out += chunk[1]
+
+        return chunk
+
+    @property
+    def finished(self):
+        return self.cancelled or self.error is not None or self.runs_done == self.runs
+
+    def _publish(self):
+        event, self.updated = self.updated, asyncio.Event()
+        event.set()
+
+    def add(self, size, cnt):
+        self.cnt.update(cnt)
+        self.runs_done += size
+        self._publish()
+
+    def fail(self, error):
+        self.error = error
+        self._publish()
+
+    def cancel(self):
+        self.cancelled = True
+        self._publish()
+
+    def report(self, success_rate):
+        """What gets sent to a listener """
+
+        report = {
+            "runs_done": self.runs_done,
+            "runs": self.runs,
+            "seed": self.entropy,
+            "done": self.finished,
+            "headers": HEADERS,
+            "table": monte_carlo.success_table(self.cnt, success_rate) if self.runs_done else [],
+        }
+
+        if self.error is not None:
+            report["error"] = str(self.error)
+
+        return report
+
+
+class Dispatcher(object):
+    def __init__(self, scheduler, slots):
+        """Hands out the chunks of the jobs to the scheduler, at most
+        slots at a time, taking turns between the jobs """
+
+        self.scheduler = scheduler
+        self.slots = slots
+        self.loop = asyncio.get_running_loop()
+
+        # Jobs with chunks left, in turn order
+        self.queue = deque()
+        self.in_flight = 0
+
+    def add(self, job):
+        self.queue.append(job)
+        self._fill()
+
+    def _fill(self):
+        while self.in_flight < self.slots and self.queue:
+            job = self.queue.popleft()
+
+            if not job.has_chunks:
+                continue
+
+            chunk = job.take_chunk()
+
+            # Back of the line for its next chunk
+            if job.has_chunks:
+                self.queue.append(job)
+
+            self.in_flight += 1
+            job.in_flight += 1
+
+            self.scheduler.submit_chunk(
+                monte_carlo.run_sweep_experiment, chunk, job.max_years, job.entropy,
+                callback=lambda chunk, result, job=job: self.loop.call_soon_threadsafe(self._done, job, chunk, result),
+                error_callback=lambda error, job=job: self.loop.call_soon_threadsafe(self._failed, job, error),
+                extra_args=([job.scenario],))
+
+    def _done(self, job, chunk, result):
+        self.in_flight -= 1
+        job.in_flight -= 1
+
+        if not job.cancelled:
+            job.add(chunk[1], result[0])
+
+        self._fill()
+
+    def _failed(self, job, error):
+        self.in_flight -= 1
+        job.in_flight -= 1
+
+        logger.error("A chunk failed: {0}".format(error))
+        job.fail(error)
+
+        self._fill()
+
+
+class SimulationServer(object):
+    def __init__(self, scheduler, chunk_size, update_interval=.1, max_runs=MAX_RUNS, max_years=MAX_YEARS):
+        self.scheduler = scheduler
+        self.chunk_size = chunk_size
+        self.update_interval = update_interval
+        self.max_runs = max_runs
+        self.max_years = max_years
+
+        self.dispatcher = None
+        # Key -> running job
+        self.jobs = dict()
+
+    def parse(self, body):
+        """The job's (scenario, runs, max_years, entropy, success_rate)
+        from a request body """
+
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError as error:
+            raise RequestError("Not JSON: {0}".format(error))
+
+        if not isinstance(request, dict):
+            raise RequestError("Expected a JSON object")
+
+        overrides = request.get("scenario", {})
+
+        if not isinstance(overrides, dict):
+            raise RequestError("scenario has to be a JSON object")
+
+        unknown = sorted(set(overrides) - set(monte_carlo.SCENARIO))
+
+        if unknown:
+            raise RequestError("Unknown scenario keys: {0}".format(", ".join(unknown)))
+
+        for key, value in overrides.items():
+            if key == "mortgage_rate_changes":
+                _check_rate_changes(value)
+            elif not _is_number(value):
+                raise RequestError("Scenario values have to be numbers, not {0!r} for {1}".format(value, key))
+
+        for name in ("runs", "max_years", "success_rate"):
+            if name in request and not _is_number(request[name]):
+                raise RequestError("{0} has to be a number".format(name))
+
+        try:
+            runs = int(request.get("runs", os.environ.get("RUNS", 10000)))
+            max_years = int(request.get("max_years", os.environ.get("MAX_YEARS", 100)))
+            success_rate = float(request.get("success_rate", os.environ.get("LOWER_PCT", .96)))
+            entropy = seeding.master_entropy(request.get("seed"))
+        except (TypeError, ValueError, OverflowError) as error:
+            raise RequestError(str(error))
+
+        if runs < 1 or max_years < 1:
+            raise RequestError("runs and max_years have to be at least 1")
+
+        if runs > self.max_runs:
+            raise RequestError("runs can be at most {0}".format(self.max_runs))
+
+        if max_years > self.max_years:
+            raise RequestError("max_years can be at most {0}".format(self.max_years))
+
+        return dict(monte_carlo.SCENARIO, **overrides), runs, max_years, entropy, success_rate
+
+    def job(self, scenario, runs, max_years, entropy):
+        """The running job for these, or a new one. The second value is
+        whether it was already running """
+
+        key = fingerprint(scenario=scenario, runs=runs, max_years=max_years, seed=entropy)
+        job = self.jobs.get(key)
+
+        if job is not None and not job.finished:
+            return job, True
+
+        job = Job(key, scenario, runs, max_years, entropy, self.chunk_size)
+        self.jobs[key] = job
+        self.dispatcher.add(job)
+
+        return job, False
+
+    async def stream(self, writer, job, success_rate, coalesced):
+        job.listeners += 1
+
+        try:
+            while True:
+                updated = job.updated
+                report = job.report(success_rate)
+                report["coalesced"] = coalesced
+
+                await _write_chunk(writer, json.dumps(report).encode() + b"\n")
+
+                if report["done"]:
+                    break
+
+                await updated.wait()
+
+                # Lets a few chunks pile up between updates
+                await asyncio.sleep(self.update_interval)
+        finally:
+            job.listeners -= 1
+
+            if not job.listeners and not job.finished:
+                logger.info("Nobody's listening to job {0} anymore, dropping it".format(job.key[:12]))
+                job.cancel()
+
+            if self.jobs.get(job.key) is job and job.finished:
+                del self.jobs[job.key]
+
+    def status(self):
+        return {
+            "workers": self.scheduler.worker_count,
+            "chunks_in_flight": self.dispatcher.in_flight,
+            "jobs": [{"key": job.key[:12], "runs_done": job.runs_done, "runs": job.runs, "listeners": job.listeners,
+                      "seconds": round(time.time() - job.started_at, 3)}
+                     for job in self.jobs.values()],
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await _read_request(reader)
+
+            if path == "/status" and method == "GET":
+                await _respond(writer, 200, self.status())
+            elif path == "/simulate" and method == "POST":
+                scenario, runs, max_years, entropy, success_rate = self.parse(body)
+                job, coalesced = self.job(scenario, runs, max_years, entropy)
+
+                await _start_stream(writer)
+                await self.stream(writer, job, success_rate, coalesced)
+                await _write_chunk(writer, b"")
+            elif path in ("/status", "/simulate"):
+                await _respond(writer, 405, {"error": "Method not allowed"})
+            else:
+                await _respond(writer, 404, {"error": "Not found"})
+        except RequestError as error:
+            await _respond(writer, 400, {"error": str(error)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None, unix_path=None):
+        self.dispatcher = Dispatcher(self.scheduler, self.scheduler.worker_count)
+
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+            logger.info("Listening on {0}".format(unix_path))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            logger.info("Listening on {0}:{1}".format(host, port))
+
+        # Ctrl-C, or SIGTERM from docker stop
+        stop = asyncio.Event()
+
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+
+        async with server:
+            await stop.wait()
+
+
+def _is_number(value):
+    # JSON's true and false are ints to Python
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_rate_changes(changes):
+    """mortgage_rate_changes is {age: rate}, with whole number ages
+    (strings, from JSON) """
+
+    if not isinstance(changes, dict):
+        raise RequestError("mortgage_rate_changes has to be {age: rate}")
+
+    for age, rate in changes.items():
+        try:
+            int(age)
+        except ValueError:
+            raise RequestError("mortgage_rate_changes ages have to be whole numbers, not {0!r}".format(age))
+
+        if not _is_number(rate):
+            raise RequestError("mortgage_rate_changes rates have to be numbers, not {0!r}".format(rate))
+
+
+####################################################
+# Just enough HTTP/1.1
+async def _read_request(reader):
+    """(method, path, body) """
+
+    try:
+        method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise RequestError("Bad request line")
+
+    headers = dict()
+
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+
+        if not line:
+            break
+
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError("Bad Content-Length")
+
+    if length < 0:
+        raise RequestError("Bad Content-Length")
+
+    if length > MAX_BODY:
+        raise RequestError("The request is too big")
+
+    body = await reader.readexactly(length) if length else b""
+
+    return method, path.split("?")[0], body
+
+
+async def _respond(writer, status, content):
+    body = json.dumps(content).encode() + b"\n"
+
+    writer.write("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n"
+                 "Connection: close\r\n\r\n".format(status, STATUS_TEXT[status], len(body)).encode() + body)
+    await writer.drain()
+
+
+async def _start_stream(writer):
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                 b"Connection: close\r\n\r\n")
+    await writer.drain()
+
+
+async def _write_chunk(writer, data):
+    """Empty data ends the stream """
+
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+    await writer.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves monte carlo simulations over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: 8080)")
+    parser.add_argument("--unix", help="listen on this Unix socket instead")
+    parser.add_argument("--update-interval", type=float, default=.1,
+                        help="least seconds between partial results (default: .1)")
+    parser.add_argument("--max-runs", type=int, default=MAX_RUNS,
+                        help="most runs a request can ask for (default: {0})".format(MAX_RUNS))
+    parser.add_argument("--max-years", type=int, default=MAX_YEARS,
+                        help="most years a request can ask for (default: {0})".format(MAX_YEARS))
+
+    args = parser.parse_args()
+
+    monte_carlo.SIMULATE = True
+
+    # Loaded once, and the workers inherit it
+    market_data.preload()
+
+    worker_count = int(os.environ.get("WORKERS", mp.cpu_count()))
+    chunk_size = int(os.environ.get("CHUNK_SIZE", 1000))
+
+    with Scheduler(worker_count=worker_count, chunk_size=chunk_size) as scheduler:
+        server = SimulationServer(scheduler, chunk_size, update_interval=args.update_interval,
+                                 max_runs=args.max_runs, max_years=args.max_years)
+
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+
+        logger.info("Stopped")
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Simulation results kept in shared memory.
+#
+# Instead of pickling each chunk's results back to
+# the parent, workers add them to fixed-size arrays
+# in a multiprocessing.shared_memory block. Every
+# worker has its own row (its slot), so there's no
+# locking, and the parent just sums the rows when
+# it wants the totals.
+#
+# Per relative year, it keeps:
+#   failures       - runs that ran out of money that year
+#   alive          - runs that still had money going into it
+#   solvent        - runs that still had money at the end of it
+#   balance_sum    - sum of their (the solvent runs') ending
+#                    balances
+#   balance_sumsq  - sum of the squares of those
+#   balance_hist   - histogram sketch of the ending balance of
+#                    every run (0 once it's out of money), for
+#                    the percentiles
+#   batch_*        - sums over the batches of runs of their
+#                    survivors (s) and runs (n): s^2, s*n and n^2,
+#                    and the batch count, for the standard error
+#                    of the success rate
+####################################################
+
+from collections import Counter
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from quantiles import HistogramSketch
+
+SKETCH = HistogramSketch()
+
+# Name, dtype, and the shape after (slots, max_years)
+FIELDS = (
+    ("failures", np.int64, ()),
+    ("alive", np.int64, ()),
+    ("solvent", np.int64, ()),
+    ("balance_sum", np.float64, ()),
+    ("balance_sumsq", np.float64, ()),
+    ("balance_hist", np.int64, (SKETCH.bins,)),
+    ("batch_survivors_sq", np.float64, ()),
+    ("batch_survivors_runs", np.float64, ()),
+    ("batch_runs_sq", np.float64, ()),
+    ("batches", np.int64, ()),
+)
+
+# Blocks this process has attached to, by name
+_attached = dict()
+
+
+class SharedAggregates(object):
+    def __init__(self, slots, max_years, name=None):
+        """Creates a new block (name is None), or attaches to an
+        existing one """
+
+        self.slots = slots
+        self.max_years = max_years
+
+        shapes = [(slots, max_years) + extra for _, _, extra in FIELDS]
+        size = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for (_, dtype, _), shape in zip(FIELDS, shapes))
+
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.arrays = dict()
+
+        offset = 0
+
+        for (field, dtype, _), shape in zip(FIELDS, shapes):
+            self.arrays[field] = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += self.arrays[field].nbytes
+
+        if name is None:
+            for array in self.arrays.values():
+                array.fill(0)
+
+    @property
+    def spec(self):
+        """What a worker needs to attach() to this block """
+
+        return (self.shm.name, self.slots, self.max_years)
+
+    def add(self, slot, fail_years, balances):
+        """Adds a batch of runs: their failure years, and their
+        (runs, max_years) ending balances """
+
+        alive = np.arange(self.max_years) <= fail_years[:, np.newaxis]
+
+        # Not the (negative) balance of the year a run ran out of money
+        solvent = alive & (balances > 0)
+        solvent_balances = np.where(solvent, balances, 0)
+
+        self.arrays["failures"][slot] += np.bincount(fail_years, minlength=self.max_years)
+        self.arrays["alive"][slot] += alive.sum(axis=0)
+        self.arrays["solvent"][slot] += solvent.sum(axis=0)
+        self.arrays["balance_sum"][slot] += solvent_balances.sum(axis=0)
+        self.arrays["balance_sumsq"][slot] += (solvent_balances ** 2).sum(axis=0)
+
+        # Out of money stays out of money
+        after_failure = np.arange(self.max_years) > fail_years[:, np.newaxis]
+        self.arrays["balance_hist"][slot] += SKETCH.counts(np.where(after_failure, 0, balances))
+
+        # Every batch is sampled on its own, so the batches are independent
+        # even when the runs in them aren't
+        runs = len(fail_years)
+        survivors = alive.sum(axis=0).astype(np.float64)
+
+        self.arrays["batch_survivors_sq"][slot] += survivors ** 2
+        self.arrays["batch_survivors_runs"][slot] += survivors * runs
+        self.arrays["batch_runs_sq"][slot] += runs ** 2
+        self.arrays["batches"][slot] += 1
+
+    def total(self, field):
+        return self.arrays[field].sum(axis=0)
+
+    def failures(self):
+        """The failure year counts, same as a Counter from run_experiment() """
+
+        counts = self.total("failures")
+        years = np.flatnonzero(counts)
+
+        return Counter(dict(zip(years.tolist(), counts[years].tolist())))
+
+    def balance_stats(self):
+        """Mean and standard deviation of the ending balance of the runs
+        that still had money at the end of the year, for every relative year """
+
+        solvent = np.maximum(self.total("solvent"), 1)
+        mean = self.total("balance_sum") / solvent
+        variance = np.maximum(self.total("balance_sumsq") / solvent - mean ** 2, 0)
+
+        return mean, np.sqrt(variance)
+
+    def batch_count(self):
+        """How many batches the standard errors are from """
+
+        return int(self.total("batches")[0])
+
+    def success_std_errors(self):
+        """Standard error of the success rate (the share of runs that
+        made it to the year) for every relative year, from the spread
+        between batches. None with less than two batches """
+
+        batches = self.batch_count()
+
+        if batches < 2:
+            return None
+
+        runs = self.total("alive")[0]
+        pct = self.total("alive") / runs
+
+        spread = (self.total("batch_survivors_sq") - 2 * pct * self.total("batch_survivors_runs") +
+                  pct ** 2 * self.total("batch_runs_sq"))
+
+        return np.sqrt(np.maximum(spread, 0) * batches / (batches - 1)) / runs
+
+    def balance_percentiles(self, pcts):
+        """The pcts (0-100) percentiles of the balance (0 once out of money)
+        for every relative year, as a (max_years, len(pcts)) matrix """
+
+        return SKETCH.quantiles(self.total("balance_hist"), pcts)
+
+    def close(self):
+        # The arrays point into the block, so they have to go first
+        self.arrays = dict()
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def attach(spec):
+    """Attaches to the block from a SharedAggregates.spec (once per process) """
+
+    name, slots, max_years = spec
+
+    if name not in _attached:
+        _attached[name] = SharedAggregates(slots, max_years, name=name)
+
+    return _attached[name]
+
+
+class SharedRunner(object):
+    """Stands in for a Scheduler's run(), with the results going through
+    the shared block. experiment is called as
+    experiment(iterations, max_years, seed, aggregates.spec) and adds its
+    results to the block (at its worker slot) instead of returning them """
+
+    def __init__(self, scheduler, aggregates):
+        self.scheduler = scheduler
+        self.aggregates = aggregates
+
+        self.chunk_size = scheduler.chunk_size
+
+    def run(self, experiment, runs, max_years, entropy, start_chunk=0):
+        before = self.aggregates.failures()
+
+        for _ in self.scheduler.imap(experiment, runs, max_years, entropy, start_chunk, extra_args=(self.aggregates.spec,)):
+            pass
+
+        return self.aggregates.failures() - before
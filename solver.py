@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Solves for a scenario value, instead of reporting
+# on the one in SCENARIO: the highest spending (or the
+# earliest retirement) that still gets LOWER_PCT of
+# the runs through SOLVE_YEARS without running out of
+# money.
+#
+# The rate paths are sampled once, into shared memory,
+# and every value is tried on the same paths, so the
+# success rate only moves because the value did. Each
+# pass tries SOLVE_POINTS values between the best value
+# known to work and the closest one known not to.
+#
+# More spending never helps a run, so every run also
+# keeps the highest spending it's known to survive and
+# the lowest it's known to fail at. A run only gets
+# simulated again for a value between those two, which
+# after the first few passes is hardly any of them.
+####################################################
+
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import seeding
+from convergence import wilson_interval
+
+# Scenario key -> (which end is the answer, whole numbers only,
+#                  more of it never helps a run)
+PARAMETERS = {
+    "monthly_living_expenses": ("max", False, True),
+    "monthly_petty_expenses": ("max", False, True),
+    "retire_monthly_living_expenses": ("max", False, True),
+    "retire_monthly_petty_expenses": ("max", False, True),
+    "retire_age": ("min", True, False),
+}
+
+# The rate paths the batch engine needs
+PATH_FIELDS = ("cascaded_inflation_rates", "historical_returns", "conservative_returns")
+
+# Spending above this is taken as "any amount works"
+SPENDING_LIMIT = 1e9
+
+# Where the shared memory blocks live (on Linux)
+SHM_PATH = "/dev/shm"
+
+# Blocks this process has attached to, by name
+_attached = dict()
+
+
+def _check_room(size):
+    """Fails up front if SHM_PATH can't hold size bytes. Otherwise the
+    workers die with a SIGBUS when they fill it (Docker only gives
+    containers 64MB there, unless it's run with --shm-size) """
+
+    try:
+        stat = os.statvfs(SHM_PATH)
+    except OSError:
+        return
+
+    free = stat.f_bavail * stat.f_frsize
+
+    if size > free:
+        raise RuntimeError("SOLVE_FOR needs {0:.0f}MB of shared memory for the rate paths of RUNS x MAX_YEARS, but {1} "
+                           "only has {2:.0f}MB free. Use fewer RUNS or MAX_YEARS, or give it more room (e.g. "
+                           "docker run --shm-size={3}m)".format(size / 2 ** 20, SHM_PATH, free / 2 ** 20,
+                                                                int(size / 2 ** 20 * 1.1) + 1))
+
+
+class SharedPaths(object):
+    def __init__(self, runs, max_years, chunk_size, name=None):
+        """Creates a new block (name is None), or attaches to an
+        existing one """
+
+        self.runs = runs
+        self.max_years = max_years
+        self.chunk_size = chunk_size
+
+        path_bytes = len(PATH_FIELDS) * runs * max_years * 8
+        size = path_bytes + 2 * runs * 8
+
+        if name is None:
+            _check_room(size)
+
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+
+        self.paths = np.ndarray((len(PATH_FIELDS), runs, max_years), dtype=np.float64, buffer=self.shm.buf)
+
+        # Per run: the highest value it's known to survive, and the
+        # lowest it's known to fail at
+        self.survives_up_to = np.ndarray((runs,), dtype=np.float64, buffer=self.shm.buf, offset=path_bytes)
+        self.fails_from = np.ndarray((runs,), dtype=np.float64, buffer=self.shm.buf, offset=path_bytes + runs * 8)
+
+        if name is None:
+            self.reset()
+
+    @property
+    def spec(self):
+        """What a worker needs to attach() to this block """
+
+        return (self.shm.name, self.runs, self.max_years, self.chunk_size)
+
+    def reset(self):
+        """Forgets what's known about every run (for a new parameter) """
+
+        self.survives_up_to.fill(-np.inf)
+        self.fails_from.fill(np.inf)
+
+    def rows(self, seed, iterations):
+        """The rows of the chunk with that seed """
+
+        offset = seeding.chunk_index(seed) * self.chunk_size
+
+        return slice(offset, offset + iterations)
+
+    def store(self, offset, paths):
+        runs = len(paths[PATH_FIELDS[0]])
+
+        for field_index, field in enumerate(PATH_FIELDS):
+            self.paths[field_index, offset:offset + runs] = paths[field][:, :self.max_years]
+
+    def evaluate(self, rows, parameter, value, survivors):
+        """How many of the runs in rows survive with parameter at value,
+        and how many of them had to be simulated to know that.
+        survivors(paths) simulates the paths it's given """
+
+        paths = {field: self.paths[field_index, rows] for field_index, field in enumerate(PATH_FIELDS)}
+
+        if not PARAMETERS[parameter][2]:
+            return int(survivors(paths).sum()), len(paths[PATH_FIELDS[0]])
+
+        survives_up_to = self.survives_up_to[rows]
+        fails_from = self.fails_from[rows]
+
+        undecided = np.flatnonzero((survives_up_to < value) & (value < fails_from))
+
+        if len(undecided):
+            survived = survivors({field: matrix[undecided] for field, matrix in paths.items()})
+
+            # These are views of the block, so the workers on the next pass see them
+            survives_up_to[undecided[survived]] = value
+            fails_from[undecided[~survived]] = value
+
+        return int(np.count_nonzero(survives_up_to >= value)), len(undecided)
+
+    def close(self):
+        # The arrays point into the block, so they have to go first
+        self.paths = self.survives_up_to = self.fails_from = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def attach(spec):
+    """Attaches to the block from a SharedPaths.spec (once per process) """
+
+    name, runs, max_years, chunk_size = spec
+
+    if name not in _attached:
+        _attached[name] = SharedPaths(runs, max_years, chunk_size, name=name)
+
+    return _attached[name]
+
+
+def success_thresholds(runs, success_rate, z):
+    """The fewest surviving runs it takes for the success rate to be
+    at least success_rate: as measured ("answer"), and at the low
+    ("conservative") and high ("optimistic") end of its confidence
+    interval """
+
+    survivors = np.arange(runs + 1)
+    lower, upper = wilson_interval(survivors, runs, z)
+
+    def fewest(pcts):
+        meets = np.flatnonzero(pcts >= success_rate)
+        return int(meets[0]) if len(meets) else runs + 1
+
+    return {
+        "answer": fewest(survivors / runs),
+        "conservative": fewest(lower),
+        "optimistic": fewest(upper),
+    }
+
+
+class Solver(object):
+    def __init__(self, scheduler, experiment, shared, parameter, start_value, runs, max_years, entropy, horizon,
+                 limits=None, points=8, tolerance=1):
+        """experiment is called as
+        experiment(iterations, max_years, seed, shared.spec, parameter, values, horizon)
+        and returns the number of runs in the chunk that survive for each
+        of values, and how many runs it simulated.
+
+        Spending is searched from 0 up, starting around start_value. Other
+        parameters are searched within limits (lowest, highest) """
+
+        if parameter not in PARAMETERS:
+            raise ValueError("Can't solve for {0} (use one of {1})".format(parameter, ", ".join(sorted(PARAMETERS))))
+
+        self.scheduler = scheduler
+        self.experiment = experiment
+        self.shared = shared
+        self.parameter = parameter
+        self.start_value = start_value
+        self.runs = runs
+        self.max_years = max_years
+        self.entropy = entropy
+        self.horizon = horizon
+        self.limits = limits
+        self.points = points
+
+        self.goal, self.integer, _ = PARAMETERS[parameter]
+        self.tolerance = max(tolerance, 1) if self.integer else tolerance
+
+        # Value -> surviving runs
+        self.counts = dict()
+        self.passes = 0
+        self.simulated = 0
+
+    def evaluate(self, values):
+        """Runs the values that haven't been yet, all in one pass """
+
+        values = sorted(set(values) - set(self.counts))
+
+        if not values:
+            return
+
+        counts = np.zeros(len(values), dtype=np.int64)
+
+        for chunk_counts, simulated in self.scheduler.imap(self.experiment, self.runs, self.max_years, self.entropy,
+                                                           extra_args=(self.shared.spec, self.parameter, values, self.horizon)):
+            counts += chunk_counts
+            self.simulated += simulated
+
+        self.counts.update(zip(values, counts.tolist()))
+        self.passes += 1
+
+    def bracket(self, threshold):
+        """A value that gets threshold survivors and one that doesn't. Either
+        is None if every value does (or none does) """
+
+        if self.goal == "min":
+            # Retiring: the latest is the safest
+            bad, good = self.limits
+
+            self.evaluate([good, bad])
+
+            if self.counts[good] < threshold:
+                return None, good
+
+            if self.counts[bad] >= threshold:
+                return bad, None
+
+            return good, bad
+
+        # Spending: nothing is as good as it gets, then look further and
+        # further out for too much
+        good = 0
+        step = max(self.start_value, 1)
+
+        while step < SPENDING_LIMIT:
+            candidates = [step * 4 ** index for index in range(self.points)]
+            self.evaluate([good] + candidates)
+
+            if self.counts[good] < threshold:
+                return None, good
+
+            for value in candidates:
+                if self.counts[value] < threshold:
+                    return good, value
+
+                good = value
+
+            step = candidates[-1] * 4
+
+        return good, None
+
+    def narrow(self, good, bad, threshold):
+        """Closes in on where threshold survivors stops being met, to
+        within the tolerance. Returns the last good value """
+
+        while abs(bad - good) > self.tolerance:
+            candidates = np.linspace(good, bad, self.points + 2)[1:-1]
+
+            if self.integer:
+                candidates = np.unique(np.round(candidates).astype(np.int64))
+                candidates = [int(value) for value in candidates if value not in (good, bad)]
+            else:
+                candidates = candidates.tolist()
+
+            if not candidates:
+                break
+
+            self.evaluate(candidates)
+
+            # Walk from the good end towards the bad one
+            for value in sorted(candidates, key=lambda value: abs(value - good)):
+                if self.counts[value] >= threshold:
+                    good = value
+                else:
+                    bad = value
+                    break
+
+        return good
+
+    def solve(self, success_rate, z):
+        """The answer, and the ends of its confidence band, as a dict (see
+        success_thresholds()). A value is None if even the best possible
+        value doesn't get there. If any value gets there, it's the
+        limit of what was tried """
+
+        results = dict()
+
+        for name, threshold in success_thresholds(self.runs, success_rate, z).items():
+            good, bad = self.bracket(threshold)
+
+            if good is None or bad is None:
+                results[name] = good
+            else:
+                results[name] = self.narrow(good, bad, threshold)
+
+        return results
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Parameter sweeps: evaluate a list (or grid) of
+# scenarios in one job.
+#
+# Every chunk draws its rate paths once and runs all
+# of the scenarios on them (common random numbers),
+# so the differences between scenarios come from the
+# scenarios, not from the luck of the draw.
+#
+# The sweep file is JSON or YAML, and only needs the
+# SCENARIO keys that change:
+#
+#   scenarios:
+#     - name: retire early
+#       retire_age: 62
+#   grid:
+#     retire_age: [62, 65, 67]
+#     monthly_living_expenses: [888, 1000]
+####################################################
+
+import itertools
+import json
+import os
+from collections import Counter
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def _read_file(path):
+    with open(path) as fh:
+        if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+            if yaml is None:
+                raise RuntimeError("PyYAML is needed to read {0} (or use a .json file)".format(path))
+
+            return yaml.safe_load(fh)
+
+        return json.load(fh)
+
+
+def _describe(overrides):
+    return ", ".join("{0}={1}".format(key, value) for key, value in sorted(overrides.items())) or "base scenario"
+
+
+def expand(spec):
+    """Turns a sweep spec into a list of scenario overrides. The spec is
+    a list of overrides, or a dict with a "scenarios" list and/or a
+    "grid" of key -> values (every combination is a scenario) """
+
+    if isinstance(spec, list):
+        spec = {"scenarios": spec}
+
+    overrides = [dict(scenario) for scenario in spec.get("scenarios", [])]
+
+    grid = spec.get("grid", {})
+    keys = sorted(grid)
+
+    for values in itertools.product(*[grid[key] for key in keys]):
+        overrides.append(dict(zip(keys, values)))
+
+    return overrides
+
+
+def load_scenarios(path, base_scenario):
+    """Returns a list of (name, scenario) from a sweep file, where each
+    scenario is base_scenario with the file's overrides applied """
+
+    scenarios = list()
+
+    for overrides in expand(_read_file(path)):
+        name = overrides.pop("name", None) or _describe(overrides)
+
+        unknown = set(overrides) - set(base_scenario)
+        if unknown:
+            raise ValueError("Unknown scenario keys in {0}: {1}".format(path, ", ".join(sorted(unknown))))
+
+        scenario = dict(base_scenario)
+        scenario.update(overrides)
+        scenarios.append((name, scenario))
+
+    return scenarios
+
+
+def run_sweep(scheduler, experiment, scenarios, runs, max_years, entropy):
+    """experiment is called as experiment(iterations, max_years, seed, scenarios)
+    and returns one failure Counter per scenario. Returns the merged
+    Counters, in the same order as scenarios """
+
+    counters = [Counter() for _ in scenarios]
+    only_scenarios = [scenario for _, scenario in scenarios]
+
+    for results in scheduler.imap(experiment, runs, max_years, entropy, extra_args=(only_scenarios,)):
+        for cnt, rel_years in zip(counters, results):
+            cnt.update(rel_years)
+
+    return counters
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+####################################################
+# The batch engine has to give the same results as
+# the scalar loop in run_experiment(). Both are fed
+# the same rate paths (from RateSampler.sample()),
+# and every run has to run out of money in the same
+# year.
+#
+#   python3 -m unittest test_batch_engine
+####################################################
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import FinanceFuture as future
+import batch_engine as batch
+import monte_carlo
+import rate_sampler
+import seeding
+
+MAX_YEARS = 100
+RUNS = 300
+
+
+def _paths(runs, max_years, seed):
+    """Rate paths for runs, the way the experiments draw them """
+
+    ff = future.FinanceFuture(max_years=max_years, rng=np.random.default_rng(seed))
+
+    return ff.sampler.sample(runs)
+
+
+def _loop_failure_years(scenario, max_years, paths):
+    """The year each run failed in, from run_experiment(), run by run
+    on the rows of paths """
+
+    runs = len(paths["inflation_rates"])
+    rows = list()
+
+    def replay(sampler, count):
+        row = rows.pop(0)
+
+        return {name: matrix[row:row + 1] for name, matrix in paths.items()}
+
+    fail_years = list()
+
+    with mock.patch.object(monte_carlo, "SCENARIO", scenario), \
+            mock.patch.object(monte_carlo, "SIMULATE", True, create=True), \
+            mock.patch.object(rate_sampler.RateSampler, "sample", replay):
+        for run in range(runs):
+            # FinanceFuture draws one path when it's made, then the run's
+            rows[:] = [run, run]
+            rel_years = monte_carlo.run_experiment(1, max_years, seeding.chunk_seed(1, 0))
+            fail_years.extend(rel_years)
+
+    return np.array(fail_years)
+
+
+class BatchEngineTest(unittest.TestCase):
+    def assertSameFailures(self, scenario, seed):
+        paths = _paths(RUNS, MAX_YEARS, seed)
+
+        expected = _loop_failure_years(scenario, MAX_YEARS, paths)
+        fail_years = batch.failure_years(batch.simulate(scenario, MAX_YEARS, paths))
+
+        np.testing.assert_array_equal(fail_years, expected)
+
+        # Some runs fail, or there'd be nothing to compare
+        self.assertTrue((fail_years < MAX_YEARS - 1).any())
+
+    def test_default_scenario(self):
+        self.assertSameFailures(monte_carlo.SCENARIO, seed=1)
+
+    def test_mortgage(self):
+        scenario = dict(monte_carlo.SCENARIO, mortgage_principal=150000, mortgage_rate=.05, mortgage_years=30,
+                        mortgage_start_age=25, mortgage_rate_changes={"35": .07, "45": .03})
+
+        self.assertSameFailures(scenario, seed=2)
+
+    def test_retiring_early(self):
+        scenario = dict(monte_carlo.SCENARIO, retire_age=55, retirement_401k_contribution=500)
+
+        self.assertSameFailures(scenario, seed=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
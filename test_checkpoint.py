@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Runs picked up from a checkpoint at retirement (see
+# checkpoint.py) have to end up the same as runs that
+# were simulated all the way through, for what-ifs
+# that only change the retirement years.
+#
+#   python3 -m unittest test_checkpoint
+####################################################
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import checkpoint
+import monte_carlo
+import seeding
+
+MAX_YEARS = 100
+RUNS = 1000
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        # A few batches per chunk
+        patch = mock.patch.dict(os.environ, BATCH_SIZE="300")
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.store = checkpoint.CheckpointStore(directory.name, "test")
+
+    def assertResumesLikeFullRuns(self, scenarios, chunk_index=3):
+        seed = seeding.chunk_seed(11, chunk_index)
+        expected = monte_carlo.run_sweep_experiment(RUNS, MAX_YEARS, seed, scenarios)
+
+        # The first time saves the checkpoint, the second picks it up
+        for _ in range(2):
+            self.assertEqual(monte_carlo.run_checkpointed_sweep(RUNS, MAX_YEARS, seed, scenarios, self.store.spec),
+                             expected)
+
+        self.assertEqual(self.store.saved_chunks(), 1)
+
+        # Anything after retiring can change
+        what_ifs = [dict(scenario, retire_monthly_living_expenses=scenario["retire_monthly_living_expenses"] * 1.5)
+                    for scenario in scenarios]
+
+        self.assertEqual(monte_carlo.run_checkpointed_sweep(RUNS, MAX_YEARS, seed, what_ifs, self.store.spec),
+                         monte_carlo.run_sweep_experiment(RUNS, MAX_YEARS, seed, what_ifs))
+
+    def test_default_scenario(self):
+        self.assertResumesLikeFullRuns([monte_carlo.SCENARIO])
+
+    def test_sweep_with_a_mortgage(self):
+        scenario = dict(monte_carlo.SCENARIO, mortgage_principal=150000, mortgage_start_age=30,
+                        mortgage_years=40, retire_monthly_petty_expenses=400)
+
+        self.assertResumesLikeFullRuns([scenario, dict(scenario, retire_monthly_petty_expenses=0)])
+
+    def test_checkpoint_is_small(self):
+        self.assertResumesLikeFullRuns([monte_carlo.SCENARIO])
+
+        size = sum(entry.stat().st_size for entry in os.scandir(self.store.directory))
+
+        # The balance and the 401k (float64) and failed_in (int16), plus
+        # the .npz's headers
+        self.assertLess(size, RUNS * 18 + 2048)
+
+
+if __name__ == "__main__":
+    unittest.main()
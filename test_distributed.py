@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Runs a job on worker daemons on localhost (see
+# distributed.py), and checks the failure histogram
+# is the same as from a local Scheduler with the same
+# seed. That includes when a worker is killed in the
+# middle of a chunk, and its chunk goes to another,
+# and when a worker with other code shows up.
+#
+#   python3 -m unittest test_distributed
+####################################################
+
+import glob
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from functools import partial
+from unittest import mock
+
+import monte_carlo
+import seeding
+from scheduler import Scheduler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+RUNS = 4000
+MAX_YEARS = 100
+CHUNK_SIZE = 500
+ENTROPY = seeding.master_entropy(7)
+
+
+def stall_once(iterations, max_years, seed, marker):
+    """run_batch_experiment(), except the first worker to get here writes
+    its pid to marker and hangs (until it's killed) """
+
+    try:
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return monte_carlo.run_batch_experiment(iterations, max_years, seed)
+
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+
+    while True:
+        time.sleep(1)
+
+
+class DistributedTest(unittest.TestCase):
+    def setUp(self):
+        self.env = dict(os.environ, COORDINATOR_AUTHKEY="test", COORDINATOR="127.0.0.1:0", WORKER_TIMEOUT="6")
+        self.patches = [mock.patch.dict(os.environ, self.env),
+                        mock.patch.object(monte_carlo, "SIMULATE", True, create=True)]
+
+        for patch in self.patches:
+            patch.start()
+
+        self.daemons = list()
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            # serve() stops its workers on Ctrl-C
+            daemon.send_signal(signal.SIGINT)
+
+        for daemon in self.daemons:
+            try:
+                daemon.wait(10)
+            except subprocess.TimeoutExpired:
+                daemon.kill()
+                daemon.wait()
+
+        for patch in self.patches:
+            patch.stop()
+
+    def start_workers(self, address, count, code_dir=HERE):
+        for _ in range(count):
+            self.daemons.append(subprocess.Popen(
+                [sys.executable, os.path.join(code_dir, "distributed.py"), "worker",
+                 "--coordinator", "{0}:{1}".format(*address), "--processes", "1"],
+                cwd=code_dir, env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def local_histogram(self):
+        with Scheduler(worker_count=2, chunk_size=CHUNK_SIZE) as scheduler:
+            return scheduler.run(monte_carlo.run_batch_experiment, RUNS, MAX_YEARS, ENTROPY)
+
+    def test_same_as_local(self):
+        expected = self.local_histogram()
+
+        with monte_carlo.make_scheduler(0, CHUNK_SIZE) as scheduler:
+            self.start_workers(scheduler.address, 2)
+            cnt = scheduler.run(monte_carlo.run_batch_experiment, RUNS, MAX_YEARS, ENTROPY)
+
+        self.assertEqual(cnt, expected)
+        self.assertEqual(sum(cnt.values()), RUNS)
+
+    def test_killed_worker_is_requeued(self):
+        expected = self.local_histogram()
+
+        with tempfile.TemporaryDirectory() as directory:
+            marker = os.path.join(directory, "stalled")
+
+            with monte_carlo.make_scheduler(0, CHUNK_SIZE) as scheduler:
+                self.start_workers(scheduler.address, 3)
+
+                results = scheduler.imap(partial(stall_once, marker=marker), RUNS, MAX_YEARS, ENTROPY)
+                cnt = Counter(next(results))
+
+                # By now one of the workers is hung on a chunk
+                while not os.path.exists(marker) or not os.path.getsize(marker):
+                    time.sleep(.1)
+
+                with open(marker) as fh:
+                    os.kill(int(fh.read()), signal.SIGKILL)
+
+                for rel_years in results:
+                    cnt.update(rel_years)
+
+        self.assertEqual(cnt, expected)
+        self.assertEqual(sum(cnt.values()), RUNS)
+
+    def test_other_code_version_takes_no_chunks(self):
+        expected = self.local_histogram()
+        results = list()
+
+        with tempfile.TemporaryDirectory() as directory:
+            # A copy of the code that's one comment off
+            for path in glob.glob(os.path.join(HERE, "*.py")):
+                shutil.copy(path, directory)
+
+            with open(os.path.join(directory, "distributed.py"), "a") as fh:
+                fh.write("# Some other version\n")
+
+            with monte_carlo.make_scheduler(0, CHUNK_SIZE) as scheduler:
+                self.start_workers(scheduler.address, 1, code_dir=directory)
+
+                job = threading.Thread(target=lambda: results.append(
+                    scheduler.run(monte_carlo.run_batch_experiment, RUNS, MAX_YEARS, ENTROPY)), daemon=True)
+                job.start()
+
+                # Long enough for it to have taken chunks, if it were going to
+                time.sleep(3)
+                self.start_workers(scheduler.address, 1)
+
+                job.join(60)
+                self.assertFalse(job.is_alive(), "The job didn't finish")
+
+        self.assertEqual(results, [expected])
+
+
+if __name__ == "__main__":
+    unittest.main()
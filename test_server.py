@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Runs the simulation server (see server.py) on a
+# Unix socket, and checks what comes back: the
+# streamed JSON lines (the last of which has to match
+# a local run with the same seed), the 400s for bad
+# requests, and that the same request twice shares
+# one job.
+#
+#   python3 -m unittest test_server
+####################################################
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+import monte_carlo
+import seeding
+from scheduler import Scheduler
+from server import SimulationServer
+
+CHUNK_SIZE = 500
+MAX_YEARS = 100
+
+
+async def _request(path, method, url, body=b"", headers=None):
+    """(status, [JSON lines of the body]) """
+
+    reader, writer = await asyncio.open_unix_connection(path)
+
+    headers = dict({"Content-Length": str(len(body))}, **(headers or {}))
+    writer.write("{0} {1} HTTP/1.1\r\n{2}\r\n".format(
+        method, url, "".join("{0}: {1}\r\n".format(*header) for header in headers.items())).encode() + body)
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ")[1])
+
+    if b"chunked" in head:
+        data = b""
+
+        while True:
+            size, _, body = body.partition(b"\r\n")
+            size = int(size, 16)
+
+            if not size:
+                break
+
+            data, body = data + body[:size], body[size + 2:]
+
+        body = data
+
+    return status, [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+class SimulationServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scheduler = Scheduler(worker_count=2, chunk_size=CHUNK_SIZE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.scheduler.close()
+
+    def serve(self, client):
+        """Runs client(socket path) against a server that's up for as long
+        as it takes """
+
+        async def main(path):
+            server = SimulationServer(self.scheduler, CHUNK_SIZE, update_interval=.01, max_runs=100000)
+            serving = asyncio.ensure_future(server.serve(unix_path=path))
+
+            while not os.path.exists(path):
+                await asyncio.sleep(.01)
+
+            try:
+                return await client(path)
+            finally:
+                serving.cancel()
+
+        with tempfile.TemporaryDirectory() as directory:
+            return asyncio.run(main(os.path.join(directory, "server.sock")))
+
+    def expected_table(self, runs, seed):
+        cnt = self.scheduler.run(monte_carlo.run_batch_experiment, runs, MAX_YEARS, seeding.master_entropy(seed))
+
+        return monte_carlo.success_table(cnt, .96)
+
+    def test_stream(self):
+        body = json.dumps({"runs": 3200, "seed": 5, "max_years": MAX_YEARS, "success_rate": .96}).encode()
+        status, lines = self.serve(lambda path: _request(path, "POST", "/simulate", body))
+
+        self.assertEqual(status, 200)
+        self.assertTrue(lines[-1]["done"])
+        self.assertFalse(any(line["done"] for line in lines[:-1]))
+        self.assertEqual(lines[-1]["runs_done"], 3200)
+        self.assertEqual(lines[-1]["seed"], 5)
+        self.assertEqual([line["runs_done"] for line in lines], sorted(line["runs_done"] for line in lines))
+
+        # Through JSON, the rows are lists
+        self.assertEqual(lines[-1]["table"], [list(row) for row in self.expected_table(3200, 5)])
+
+    def test_bad_requests(self):
+        requests = [
+            (b"not json", None),
+            (b"[1, 2]", None),
+            (json.dumps({"runs": 10 ** 12}).encode(), None),
+            (json.dumps({"max_years": 1000}).encode(), None),
+            (json.dumps({"runs": 0}).encode(), None),
+            (json.dumps({"runs": True}).encode(), None),
+            (json.dumps({"scenario": {"retire_age": True}}).encode(), None),
+            (json.dumps({"scenario": {"no_such_key": 1}}).encode(), None),
+            (json.dumps({"scenario": {"mortgage_rate_changes": {"soon": .05}}}).encode(), None),
+            (json.dumps({"scenario": {"mortgage_rate_changes": {"40": "high"}}}).encode(), None),
+            (b"{}", {"Content-Length": "lots"}),
+        ]
+
+        async def client(path):
+            return [await _request(path, "POST", "/simulate", body, headers) for body, headers in requests]
+
+        for (body, _), (status, lines) in zip(requests, self.serve(client)):
+            self.assertEqual(status, 400, body)
+            self.assertIn("error", lines[0])
+
+    def test_not_found(self):
+        async def client(path):
+            return [(await _request(path, "GET", "/nowhere"))[0], (await _request(path, "GET", "/simulate"))[0]]
+
+        self.assertEqual(self.serve(client), [404, 405])
+
+    def test_same_request_coalesces(self):
+        body = json.dumps({"runs": 40000, "seed": 9}).encode()
+
+        async def client(path):
+            first = asyncio.ensure_future(_request(path, "POST", "/simulate", body))
+
+            # Until the first one's job is running
+            while not (await _request(path, "GET", "/status"))[1][0]["jobs"]:
+                await asyncio.sleep(.01)
+
+            second = await _request(path, "POST", "/simulate", body)
+
+            return await first, second
+
+        (_, first), (_, second) = self.serve(client)
+
+        self.assertFalse(first[0]["coalesced"])
+        self.assertTrue(second[0]["coalesced"])
+        self.assertEqual(first[-1]["table"], second[-1]["table"])
+        self.assertEqual(second[-1]["runs_done"], 40000)
+
+
+if __name__ == "__main__":
+    unittest.main()
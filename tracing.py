@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+####################################################
+# Year-by-year traces of a few runs out of a big job.
+#
+# With TRACE_SAMPLE and/or TRACE_WORST set, the workers
+# keep the yearly numbers (raw floats) of:
+#   - a random sample of TRACE_SAMPLE runs. Every run
+#     gets a random priority, and the lowest ones are
+#     kept (a reservoir sample that merges exactly)
+#   - the TRACE_WORST worst runs: the ones that ran out
+#     of money first, then the lowest balance then
+#
+# Both are heaps of the k smallest keys, so the
+# workers' traces merge into the same ones no matter
+# how the chunks were split up. The yearly numbers are
+# only worked out for the runs that make it in, and
+# every worker remembers the keys it has seen for the
+# job, so a later chunk skips runs that can't make it
+# in anyway.
+#
+# Nothing is formatted until the report: a table per
+# run, or all of them to TRACE_FILE (.csv or .json).
+####################################################
+
+import csv
+import heapq
+import json
+import locale
+from collections import Counter
+
+import numpy as np
+
+FIELDS = ("yearly_income", "yearly_expenses", "inflation_rate", "investment_return", "investment_money")
+
+# The keys this process has seen, for the job it last worked on
+_seen = dict()
+
+
+def _negate(key):
+    return tuple(-part for part in key)
+
+
+class _Smallest(object):
+    """Keeps the records with the size smallest keys """
+
+    def __init__(self, size):
+        self.size = size
+
+        # (negated key, record), so the largest key is on top
+        self.heap = list()
+
+    def threshold(self):
+        """Keys have to be below this to get in (None when anything does) """
+
+        if len(self.heap) < self.size:
+            return None
+
+        return _negate(self.heap[0][0])
+
+    def push(self, key, record):
+        self._push_entry((_negate(key), record))
+
+    def _push_entry(self, entry):
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif entry[0] > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def merge(self, other):
+        for entry in other.heap:
+            self._push_entry(entry)
+
+    def records(self):
+        """Smallest key first """
+
+        return [record for _, record in sorted(self.heap, key=lambda entry: entry[0], reverse=True)]
+
+
+class TraceCollector(object):
+    def __init__(self, sample_size=0, worst_size=0):
+        self.sample = _Smallest(sample_size)
+        self.worst = _Smallest(worst_size)
+
+    def offer(self, first_run, balances, fail_years, priorities, trajectories, seen=None):
+        """Offers a batch of runs, numbered from first_run: their balances
+        (from batch_engine.simulate()), failure years and a random priority
+        each. trajectories(rows) returns the yearly numbers of those rows
+        (see batch_engine.trajectories()), and is only called for the runs
+        that get in.
+
+        seen is a TraceCollector of the keys offered so far in other
+        chunks (see seen()). Runs that wouldn't get into it are skipped """
+
+        rows = np.arange(len(balances))
+        final_balances = balances[rows, fail_years]
+        ran_out = final_balances <= 0
+
+        # The runs that never ran out come after every one that did
+        fail_keys = fail_years + ~ran_out
+
+        offers = list()
+
+        for kept, past, keys in ((self.sample, seen and seen.sample, (priorities,)),
+                                 (self.worst, seen and seen.worst, (fail_keys, final_balances))):
+            if not kept.size:
+                continue
+
+            # What's been seen includes what's kept here
+            threshold = (past or kept).threshold()
+
+            # Only this batch's best few can get in
+            for row in np.lexsort(keys[::-1])[:kept.size].tolist():
+                key = tuple(part[row].item() for part in keys) + (first_run + row,)
+
+                if threshold is not None and key >= threshold:
+                    break
+
+                offers.append((kept, key, row))
+
+                if past is not None:
+                    past.push(key, None)
+
+        if not offers:
+            return
+
+        picked = sorted(set(row for _, _, row in offers))
+        detail = trajectories(np.array(picked))
+
+        for kept, key, row in offers:
+            index = picked.index(row)
+            record = {"run": first_run + row, "fail_year": int(fail_years[row]), "ran_out": bool(ran_out[row])}
+            record.update((field, detail[field][index]) for field in FIELDS)
+
+            kept.push(key, record)
+
+    def merge(self, other):
+        self.sample.merge(other.sample)
+        self.worst.merge(other.worst)
+
+    def traces(self):
+        """The kept records: the random sample (in run order), and the
+        worst runs (worst first) """
+
+        return {
+            "sample": sorted(self.sample.records(), key=lambda record: record["run"]),
+            "worst": self.worst.records(),
+        }
+
+
+def seen(job, sample_size, worst_size):
+    """The keys this process has seen so far for job (a TraceCollector
+    without records) """
+
+    if job not in _seen:
+        _seen.clear()
+        _seen[job] = TraceCollector(sample_size, worst_size)
+
+    return _seen[job]
+
+
+class TraceRunner(object):
+    """Stands in for a Scheduler's run(), for an experiment called as
+    experiment(iterations, max_years, seed, spec) that returns the failure
+    Counter and a TraceCollector for the chunk. spec is (sample size,
+    worst size, chunk size, a job id that's unique to this job) """
+
+    def __init__(self, scheduler, collector, spec):
+        self.scheduler = scheduler
+        self.collector = collector
+        self.spec = spec
+
+        self.chunk_size = scheduler.chunk_size
+
+    def run(self, experiment, runs, max_years, entropy, start_chunk=0):
+        cnt = Counter()
+
+        for rel_years, traces in self.scheduler.imap(experiment, runs, max_years, entropy, start_chunk, extra_args=(self.spec,)):
+            cnt.update(rel_years)
+            self.collector.merge(traces)
+
+        return cnt
+
+
+####################################################
+# Rendering
+def _years(record):
+    """The years the run has numbers for """
+
+    return int(np.count_nonzero(~np.isnan(record["investment_money"])))
+
+
+def _dollar(value):
+    return locale.currency(value, grouping=True)
+
+
+def summary_table(traces):
+    """Headers and a row per traced run """
+
+    headers = ["Trace", "Run", "Out of Money In", "Final Balance", "Lowest Balance"]
+    table = list()
+
+    for kind in ("worst", "sample"):
+        for record in traces[kind]:
+            balances = record["investment_money"][:_years(record)]
+
+            table.append([kind, record["run"], record["fail_year"] if record["ran_out"] else "never",
+                          _dollar(balances[-1]), _dollar(balances.min())])
+
+    return headers, table
+
+
+def run_table(record, start_year):
+    """Headers and a row per year of one traced run (like the
+    run_experiment() debug table) """
+
+    headers = ["Year", "Income", "Expenses", "Inf./Int. (%)", "Investment Money"]
+    table = list()
+
+    for rel_year in range(_years(record)):
+        table.append([
+            "{:>5s} {:>6s}".format(str(start_year + rel_year), "({:+})".format(rel_year)),
+            _dollar(record["yearly_income"][rel_year]),
+            _dollar(-record["yearly_expenses"][rel_year]),
+            "{0:>5.2%} / {1:>6.2%}".format(record["inflation_rate"][rel_year], record["investment_return"][rel_year]),
+            _dollar(record["investment_money"][rel_year]),
+        ])
+
+    return headers, table
+
+
+def export(path, traces):
+    """Writes every traced run to path: CSV (a row per run and year) if
+    it ends in .csv, JSON otherwise """
+
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(("trace", "run", "fail_year", "ran_out", "rel_year") + FIELDS)
+
+            for kind, records in traces.items():
+                for record in records:
+                    for rel_year in range(_years(record)):
+                        writer.writerow([kind, record["run"], record["fail_year"], int(record["ran_out"]), rel_year] +
+                                        [repr(float(record[field][rel_year])) for field in FIELDS])
+        return
+
+    content = {kind: [dict(record, **{field: record[field][:_years(record)].tolist() for field in FIELDS})
+                      for record in records]
+               for kind, records in traces.items()}
+
+    with open(path, "w") as fh:
+        json.dump(content, fh)